@@ -1,21 +1,30 @@
+from time import perf_counter, process_time
+startup_started = perf_counter()  # Reference point for --profile-startup
 import pygame
 import sys
 import os
+import argparse
 from pygame.locals import *
-from tkinter import Tk
-from tkinter import filedialog, messagebox
 from math import inf
-import sounddevice as sd
-import soundfile as sf
+from functools import lru_cache
 import numpy as np
 import threading
-import json
-
-# v1.4.2
-# Slight refactor of code, attemps to fix solo mode bug to no avail.
-
-# Initialize Pygame
-pygame.init()
+from concurrent.futures import wait
+from stem_audio import (StemStreamer, CallbackTelemetry, StemMeters, MixGains, Limiter, SpectrogramWorker, decode_pool, read_header, prepare_track, warm_cache,
+                        choose_session_samplerate, prepare_mix_peaks, peak_columns, MIX_BLOCK_FRAMES,
+                        memory_budget, open_output, OUTPUT_BACKENDS, STRETCH_MIN_SPEED, SPECTRUM_FLOOR_DB, AUDIO_EXTENSIONS)
+import stem_tracks
+from stem_tracks import load_track_config, describe_stems
+import stem_library
+from stem_mixer import MixerProcess
+# tkinter and sounddevice are imported on first use: the window opens without them
+
+# v2.18
+# Gapless playlists: the next song's stems load in the background and start in the block the current song ends.
+
+# Initialize only the Pygame subsystems the player uses; audio goes through sounddevice or an --output backend
+pygame.display.init()
+pygame.font.init()
 
 # Set up the screen
 SCREEN_WIDTH = 1280
@@ -26,13 +35,59 @@ pygame.display.set_caption("Music Stem Player and Visualizer")
 # List to hold the tracks
 tracks = []
 total_duration = 0  # Total duration of the longest track in seconds
-playback_position = 0  # Current playback position in seconds
-playing = False
+total_frames = 0  # Length of the longest track in session frames
+playback_frame = 0  # Transport position in session frames, advanced by audio_callback
+session_samplerate = 0  # Rate every stem is converted to and the output stream runs at
+playing = False  # audio_callback mixes while True and outputs silence while False
 mute_flags = []
-audio_thread = None
-stop_event = threading.Event()
+mix_gains = np.zeros(0, dtype='float32')  # Effective gain per track (volume, 0 when muted), worked out by the UI
+gain_ramp = MixGains(0)  # Gain sets published from mix_gains, which audio_callback ramps between
+output_stream = None  # Output backend stream (see open_output) kept open for the whole session
 seek_event = threading.Event()
-seek_position = 0
+seek_frame = 0
+loop_start = None  # A/B loop points in session frames, None until set
+loop_end = None
+loop_event = threading.Event()  # Set when loop_region changes; audio_callback hands it to the streamer
+loop_region = None  # (loop_start, loop_end) once both are set, otherwise None
+playback_speed = 1.0  # Practice speed, kept when loading another song
+streamer = None  # StemStreamer feeding audio_callback for the loaded tracks
+load_jobs = []  # Pool futures preparing the current session's stems
+warm_jobs = []  # Pool futures pre-warming the cache for a folder
+telemetry = CallbackTelemetry()  # Written by audio_callback, read by the overlay
+meters = StemMeters(0)  # Per-track levels written by audio_callback, read by draw_tracks
+limiter = Limiter(44100)  # Master limiter applied by audio_callback after the mix
+limiter_meter = {'db': 0.0, 'time': 0.0}  # Gain reduction shown next to the play button, falling slowly
+mix_peaks = None  # Waveform pyramid of the whole mix, built once every stem is loaded
+mix_render = {}  # Slider waveform surface and the peaks/size it was drawn for, plus the loop shade
+spectrogram = None  # SpectrogramWorker for the session, started when the visualizer is first shown
+spectrogram_render = {}  # Ring-buffer texture of spectrogram columns and the newest column's levels
+current_session = None  # Session dict (see load_session) whose tracks the window shows
+session_gains = gain_ramp  # MixGains of current_session, which update_mix_gains publishes to
+playlist = []  # Songs to play in order, each a list of stem paths
+playlist_index = -1  # Playlist entry of current_session
+next_session = None  # The next playlist entry, loading in the background at the session rate
+queued_session = None  # next_session once fully buffered, which audio_callback switches to at the end of the song
+switched_session = None  # queued_session once audio_callback has switched to it, until update_playlist takes it over
+skip_requested = False  # Set by N: audio_callback switches to queued_session at the next block
+preloading = False  # True while a worker thread loads next_session
+preload_serial = 0  # Bumped when the playlist moves on, so a preload still running drops its result
+playlist_lock = threading.Lock()
+was_playing = False  # Playback state on the last frame, to notice the end of a song
+
+icon_cache = {}  # Icon filename -> scaled icon surface
+font_cache = {}  # Font size -> pygame font shared by every draw function
+
+# Song library browser
+library_open = False
+library_query = ""
+library_results = []  # (id, name, directory, stem_count, duration) rows matching library_query
+library_selection = 0
+library_db = None  # Connection used by the UI thread; scans open their own
+library_scan = None  # {'thread', 'progress'} while a library scan runs
+tk_root = None  # Hidden Tk root shared by every dialog, created on first use
+screen_dirty = True  # Set when the whole window must be redrawn on the next frame
+drawn_keys = {}  # Transport area -> state it was last drawn for, so unchanged areas are skipped
+frame_stats = {'draw_ms': 0.0, 'fps': 0.0, 'cpu': 0.0, 'frames': 0, 'since': perf_counter(), 'cpu_since': process_time()}
 
 # Common artist and track name
 artist_track_name = ""
@@ -42,158 +97,546 @@ settings_menu_open = False
 show_title = True
 show_full_labels = False  # Set to False by default as per your requirement
 use_title_case_labels = True
-
-
-def assign_order_indices(categories, start_index=0):
-    """Assign order indices to categories based on their position."""
-    current_index = start_index
-
-    for category_name, category_data in categories.items():
-        # Assign the current index to this category
-        category_data['order'] = current_index
-        current_index += 1
-
-        # Recursively assign order indices to subcategories
-        subcategories = category_data.get("subcategories", {})
-        if subcategories:
-            current_index = assign_order_indices(subcategories, current_index)
-    return current_index
-
-def get_track_type(filename, categories):
-    """Determine the track type based on keywords in the filename."""
-    filename_lower = filename.lower()
-    best_match_data = None
-    best_match_level = -1
-
-    def traverse_categories(categories, level=0):
-        nonlocal best_match_data, best_match_level
-        for category_name, category_data in categories.items():
-            # Check for keywords match
-            for keyword in category_data.get("keywords", []):
-                if keyword.lower() in filename_lower:
-                    if level > best_match_level:
-                        best_match_data = category_data
-                        best_match_level = level
-            # Recursively check subcategories
-            subcategories = category_data.get("subcategories", {})
-            if subcategories:
-                traverse_categories(subcategories, level + 1)
-
-    traverse_categories(categories)
-    if best_match_data:
-        return best_match_data
-    else:
-        # Return default with a high order index to place it at the end
-        return {
-            "icon": default_icon_filename,
-            "color": default_color,
-            "order": float('inf')  # Default tracks will be placed at the end
-        }
-
-def find_common_words(filenames):
-    """Find the common words in the list of filenames, preserving order."""
-    if not filenames:
-        return []
-    # Extract base names without extensions
-    bases = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
-    # Replace hyphens and underscores with spaces
-    bases = [b.replace('-', ' ').replace('_', ' ') for b in bases]
-    # Split into words
-    split_names = [b.split() for b in bases]
-    # Convert all words to lowercase for comparison
-    split_names_lower = [[word.lower() for word in words] for words in split_names]
-    # Use the first filename's words as the basis for order
-    first_words = split_names_lower[0]
-    # Initialize common words list
-    common_words = []
-    for idx, word in enumerate(first_words):
-        if all(word in other_words for other_words in split_names_lower[1:]):
-            # Use the original word from the first filename to preserve case
-            common_words.append(split_names[0][idx])
-    return common_words
+show_telemetry = False  # Callback timing overlay, toggled with T
+show_memory = False  # Memory readout per stem, toggled with M
+visualizer_mode = None  # None, 'spectrogram' or 'spectrum', cycled with V
+visualizer_track = None  # Track index the visualizer analyses, None for the mix
+match_device_samplerate = True  # Convert stems to the output device's rate, otherwise to the most common stem rate
+compact_cache = False  # Cache decoded stems as 16-bit instead of float32, halving their memory
+
+
+def load_icon(icon_filename):
+    """Load and scale a track icon once, sharing it between every track that uses it."""
+    if icon_filename not in icon_cache:
+        icon_path = os.path.join(icon_location, icon_filename)
+        icon_image = pygame.image.load(icon_path).convert_alpha()
+        # Scale icon to fit in the box
+        icon_size = (64, 64)
+        icon_cache[icon_filename] = pygame.transform.smoothscale(icon_image, icon_size)
+    return icon_cache[icon_filename]
+
+def dialog_root():
+    """Return the hidden Tk root every dialog is parented to, importing tkinter on first use."""
+    global tk_root
+    if tk_root is None:
+        from tkinter import Tk
+        tk_root = Tk()
+        tk_root.withdraw()  # Hide the root window
+    return tk_root
+
+def ask_directory(title):
+    """Ask for a folder; returns '' if the dialog is cancelled."""
+    from tkinter import filedialog
+    folder = filedialog.askdirectory(parent=dialog_root(), title=title)
+    tk_root.update()  # Let Tk finish closing the dialog
+    return folder
+
+def ask_yes_no(title, message):
+    """Ask a yes/no question; returns True for yes."""
+    from tkinter import messagebox
+    result = messagebox.askyesno(title, message, parent=dialog_root())
+    tk_root.update()
+    return result
+
+def cache_dtype():
+    """Sample format of cache files for the 16-bit cache setting."""
+    return 'int16' if compact_cache else 'float32'
+
+def match_device():
+    """Whether to convert stems to the sound card's rate; there is no device to match with a null or file output."""
+    return match_device_samplerate and args.output == 'sounddevice'
+
+def warm_cache_dialog():
+    """Ask for a folder and pre-warm the decoded-audio cache for every stem in it."""
+    global warm_jobs
+    folder = ask_directory("Pre-warm cache for folder")
+    if folder:
+        warm_jobs = [job for job in warm_jobs if not job.done()] + warm_cache(folder, match_device(), cache_dtype())
 
 def load_sound_files():
     """Function to load sound files using a file dialog."""
-    global total_duration, playback_position, playing, tracks, mute_flags, stop_event, audio_thread, artist_track_name
-    root = Tk()
-    root.withdraw()  # Hide the root window
-    file_paths = filedialog.askopenfilenames(filetypes=[("Audio Files", "*.wav *.mp3 *.flac")])
-    root.destroy()
-    if not file_paths:
-        return
-    # Stop any ongoing playback
-    if playing:
-        stop_event.set()
-        audio_thread.join()
-        playing = False
+    from tkinter import filedialog
+    file_paths = filedialog.askopenfilenames(parent=dialog_root(), filetypes=[("Audio Files", "*.wav *.mp3 *.flac")])
+    tk_root.update()  # Let Tk finish closing the dialog
+    if file_paths:
+        start_playlist([file_paths])
+
+def expand_stem_paths(paths):
+    """Stem files from the command line, with each folder replaced by the audio files directly in it."""
+    file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                              if name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            file_paths.append(path)
+    return file_paths
+
+def load_session(file_paths, samplerate=None):
+    """Label and classify a set of stems and start preparing them, leaving the current session alone.
+
+    Headers are read up front; decoding and resampling run on decode_pool, and
+    each stem streams as soon as it is ready. samplerate fixes the session rate,
+    as the playlist does so the next song can follow the current one without a gap.
+    Returns the session as a dict; it has no streamer if no stem could be opened.
+    """
+    # Label and classify the stems, finding the words common to every filename
+    if not stem_tracks.track_types:
+        load_track_config(config_file)
+    name, stems = describe_stems(file_paths)
+
+    # Read every header in parallel; the audio itself is prepared by the pool below
+    infos = decode_pool.map(read_header, [stem['path'] for stem in stems])
+
+    session_tracks = []
+    for stem, info in zip(stems, infos):
+        if info is None:
+            continue
+        try:
+            session_tracks.append({
+                'path': stem['path'],
+                'frames': info.frames,
+                'channels': info.channels,
+                'samplerate': info.samplerate,
+                'full_label': stem['full_label'],
+                'label_without_common': stem['label_without_common'],
+                'icon_filename': stem['icon_filename'],  # Loaded by track_render_cache when first drawn
+                'volume': 1.0,  # Initialize volume at 100%
+                'color': stem['color'],  # Store color from JSON
+                'order': stem['order'],  # Include the 'order' key
+                'ready': False,  # Set by prepare_track once the stem is streaming
+                'progress': 0.0,  # Fraction of the stem's decode/resample done
+                'peaks': None  # Waveform pyramid, set by prepare_track after the stem is cached
+            })
+        except Exception as e:
+            print(f"Could not load sound file {stem['path']}: {e}")
+
+    session = {'name': name, 'tracks': session_tracks,
+               'mute_flags': [False] * len(session_tracks),  # Initially, all tracks are unmuted
+               'mix_gains': np.ones(len(session_tracks), dtype='float32'),
+               'gains': MixGains(len(session_tracks)), 'meters': StemMeters(len(session_tracks)),
+               'streamer': None, 'load_jobs': [], 'mix_peaks': None,
+               'samplerate': session_samplerate, 'total_frames': 0, 'refilled': False}
+    if not session_tracks:
+        return session
+
+    # Convert every stem to one session rate so they play at the right speed and stay in sync
+    if samplerate is None:
+        samplerate = choose_session_samplerate([t['samplerate'] for t in session_tracks], match_device())
+    for track in session_tracks:
+        track['frames'] = -(-track['frames'] * samplerate // track['samplerate'])
+    total_frames = max(t['frames'] for t in session_tracks)
+
+    # Every stem streams silence until its job attaches a reader
+    if args.mixer_process:
+        stream = MixerProcess(len(session_tracks), total_frames, samplerate, args.output, args.output_file,
+                              args.realtime)
+        session['gains'] = stream.gains
+    else:
+        stream = StemStreamer([None] * len(session_tracks), total_frames)
+    stream.set_speed(playback_speed)
+    session.update(samplerate=samplerate, total_frames=total_frames, streamer=stream,
+                   load_jobs=[decode_pool.submit(prepare_track, i, track, samplerate, stream, cache_dtype())
+                              for i, track in enumerate(session_tracks)])
+    threading.Thread(target=build_mix_peaks, args=(session, cache_dtype()), daemon=True).start()
+    return session
+
+def release_session(session):
+    """Cancel a session's load jobs and stop its streamer."""
+    for job in session['load_jobs']:
+        job.cancel()
+    if session['streamer'] is not None:
+        session['streamer'].close()
+
+def session_loaded(session):
+    """True once every stem of a session is streaming, or has failed, and its streamer is buffered."""
+    return (session['streamer'] is not None and session['streamer'].is_ready()
+            and all(track['ready'] or track.get('failed') for track in session['tracks']))
+
+def install_session(session):
+    """Make a session the one the window shows; the caller sets up its audio."""
+    global current_session, total_duration, total_frames, tracks, mute_flags, mix_gains, session_gains, gain_ramp, artist_track_name, streamer, session_samplerate, load_jobs, mix_peaks, meters, spectrogram, visualizer_track, screen_dirty
+    screen_dirty = True
+    current_session = session
+    if spectrogram is not None:
+        spectrogram.close()
+        spectrogram = None
+    spectrogram_render.clear()
+    visualizer_track = None
+    artist_track_name = session['name']
+    tracks = session['tracks']
+    mute_flags = session['mute_flags']
+    mix_gains = session['mix_gains']
+    gain_ramp = session_gains = session['gains']
+    meters = session['meters']
+    streamer = session['streamer']
+    load_jobs = session['load_jobs']
+    mix_peaks = session['mix_peaks']
+    session_samplerate = session['samplerate']
+    total_frames = session['total_frames']
+    total_duration = total_frames / session_samplerate if total_frames else 0
+
+def close_session():
+    """Stop playback and free the current session and the preloaded next song."""
+    global current_session, tracks, mute_flags, gain_ramp, session_gains, streamer, load_jobs, mix_peaks
+    close_output_stream()
+    discard_next_session()
+    # Let go of the old gains first: with --mixer-process they are views of the control block being freed
+    gain_ramp = session_gains = MixGains(0)
+    if current_session is not None:
+        release_session(current_session)
+    current_session = None
+    streamer = None
+    load_jobs = []
     tracks = []
     mute_flags = []
-    max_duration = 0
+    mix_peaks = None
+
+def open_session(file_paths):
+    """Replace the current session with a set of stems, each playing as soon as it is ready."""
+    close_session()
+    start_session(load_session(file_paths))
+
+def start_session(session):
+    """Show a loaded session from its start and open its output stream."""
+    global playback_frame, limiter
+    playback_frame = 0  # Reset playback position
+    seek_event.clear()
+    install_session(session)
+    clear_loop()
+    if not tracks:
+        return
+    limiter = Limiter(session_samplerate)
+    if not args.mixer_process:
+        # The mixer process opens its own output stream
+        open_output_stream()
+    preload_next()
+
+def start_playlist(songs):
+    """Replace the playlist with songs (each a list of stem paths) and open the first one."""
+    global playlist, playlist_index
+    playlist = [list(paths) for paths in songs if paths]
+    playlist_index = 0
+    if playlist:
+        open_session(playlist[0])
+
+def queue_song(file_paths):
+    """Add a song to the end of the playlist, or open it if nothing is loaded."""
+    if not tracks:
+        start_playlist([file_paths])
+        return
+    playlist.append(list(file_paths))
+    preload_next()
+
+def preload_next():
+    """Start loading the playlist's next song on a worker thread, at the current session's rate.
+
+    Only one song is ever preloaded, so at most two sessions are in memory. With
+    --mixer-process the next song is opened when the current one ends instead.
+    """
+    global preloading
+    if (preloading or next_session is not None or args.mixer_process or not tracks
+            or playlist_index + 1 >= len(playlist)):
+        return
+    preloading = True
+    paths = playlist[playlist_index + 1]
+    serial = preload_serial
+    samplerate = session_samplerate
+
+    def preload():
+        global next_session, preloading, screen_dirty
+        session = None
+        try:
+            session = load_session(paths, samplerate)
+        except Exception as e:
+            print(f"Could not preload the next song: {e}")
+        with playlist_lock:
+            preloading = False
+            if session is not None and serial == preload_serial:
+                next_session = session
+                session = None
+                screen_dirty = True  # Show the next song's name
+        if session is not None:
+            # The playlist moved on while this song was loading
+            release_session(session)
+
+    threading.Thread(target=preload, daemon=True).start()
+
+def discard_next_session():
+    """Drop the preloaded next song; the output stream must be closed so audio_callback can't switch to it."""
+    global next_session, queued_session, switched_session, preload_serial
+    with playlist_lock:
+        preload_serial += 1  # A preload still running drops its result
+        session = next_session
+        next_session = None
+    queued_session = None
+    if switched_session is not None:
+        # audio_callback switched to the next song before update_playlist took it over
+        session = switched_session
+        switched_session = None
+    if session is not None:
+        release_session(session)
+
+def carry_presets(session):
+    """Give the next song's stems the volume and mute state of the current song's matching stems.
+
+    A stem takes the settings of the current stem with the same label, or failing
+    that of the same track type, so stems muted for one song stay muted for the
+    rest of the set. Published every frame, so changes right up to the switch count.
+    """
+    by_label = {}
+    by_type = {}
+    for track, muted in zip(tracks, mute_flags):
+        setting = (track['volume'], muted)
+        by_label.setdefault(track['label_without_common'].lower(), setting)
+        by_type.setdefault((track['icon_filename'], tuple(track['color'])), setting)
+    for i, track in enumerate(session['tracks']):
+        volume, muted = by_label.get(track['label_without_common'].lower(),
+                                     by_type.get((track['icon_filename'], tuple(track['color'])), (1.0, False)))
+        track['volume'] = volume
+        session['mute_flags'][i] = muted
+        session['mix_gains'][i] = 0.0 if muted else volume
+    session['gains'].publish(session['mix_gains'])
+
+def update_playlist():
+    """Each frame: take over a song audio_callback switched to, and get the next one ready to follow.
+
+    The next song is queued for audio_callback once it is fully buffered. When the
+    current song ends without one queued (still loading, or --mixer-process) the
+    next song is opened the ordinary way and starts as soon as it is ready.
+    """
+    global switched_session, next_session, queued_session, playlist_index, was_playing
+    preload_next()  # Picks up a song queued while a dropped preload was still finishing
+    if switched_session is not None:
+        session = switched_session
+        switched_session = None
+        next_session = None
+        release_session(current_session)  # Stops the streamer audio_callback switched away from
+        playlist_index += 1
+        install_session(session)
+        clear_loop()
+        preload_next()
+    elif was_playing and not playing and total_frames and playback_frame >= total_frames:
+        if playlist_index + 1 < len(playlist):
+            advance_playlist(True)
+    was_playing = playing
+
+    session = next_session
+    if session is None or session['streamer'] is None or session is queued_session:
+        if session is not None and session is queued_session:
+            carry_presets(session)
+        return
+    carry_presets(session)
+    if all(track['ready'] or track.get('failed') for track in session['tracks']) and not session['refilled']:
+        # Stems that joined late were buffered as silence: refill from the start with every stem in place
+        session['refilled'] = True
+        session['streamer'].seek(0)
+    elif session['refilled'] and session_loaded(session):
+        session['gains'].settle()  # Start at the carried-over gains rather than ramping to them
+        queued_session = session
+
+def advance_playlist(play):
+    """Open the playlist's next song, starting it once loaded if play is set.
+
+    Takes over the preloaded session if there is one, even if it is still loading.
+    """
+    global playlist_index, play_when_ready, next_session, queued_session, gain_ramp, session_gains
+    playlist_index += 1
+    with playlist_lock:
+        session = next_session
+        next_session = None
+    if session is None:
+        open_session(playlist[playlist_index])
+    else:
+        close_output_stream()
+        queued_session = None
+        gain_ramp = session_gains = MixGains(0)
+        release_session(current_session)
+        start_session(session)
+    play_when_ready = play
+
+def skip_to_next():
+    """Move on to the next song in the playlist, without a gap if it is already buffered."""
+    global skip_requested
+    if queued_session is not None and output_stream is not None:
+        skip_requested = True
+    elif playlist_index + 1 < len(playlist):
+        advance_playlist(playing)
+
+def switch_to_queued(session):
+    """Audio thread: make the queued song the one being mixed; update_playlist takes it over in the UI."""
+    global streamer, gain_ramp, meters, queued_session, switched_session
+    queued_session = None
+    switched_session = session
+    streamer, gain_ramp, meters = session['streamer'], session['gains'], session['meters']
+
+def open_library():
+    """Show the library browser with every song matching the last search."""
+    global library_open, library_db
+    if library_db is None:
+        library_db = stem_library.connect()
+    library_open = True
+    search_library(library_query)
+
+def search_library(query):
+    """Run a library search for the browser and select the first match."""
+    global library_query, library_results, library_selection
+    library_query = query
+    library_results = stem_library.search(library_db, query)
+    library_selection = 0
+
+def open_library_selection(index, queue=False):
+    """Open one of the browser's songs as a new playlist, or add it to the playlist if queue is set."""
+    global library_open
+    if 0 <= index < len(library_results):
+        file_paths = stem_library.song_paths(library_db, library_results[index][0])
+        if file_paths:
+            library_open = False
+            if queue:
+                queue_song(file_paths)
+            else:
+                start_playlist([file_paths])
+
+def scan_library_dialog():
+    """Ask for a folder and add every song under it to the library in the background."""
+    folder = ask_directory("Add folder to library")
+    if folder:
+        start_library_scan([folder])
+
+def start_library_scan(roots=None):
+    """Scan roots (or rescan every known root) on a worker thread."""
+    global library_scan
+    if library_scan is not None and library_scan['thread'].is_alive():
+        return
+    scan_state = {'progress': 0.0}
 
-    # Find common words among filenames
-    common_words = find_common_words(file_paths)
-    artist_track_name_words = common_words
-    artist_track_name = ' '.join(artist_track_name_words)
+    def report(fraction):
+        scan_state['progress'] = fraction
 
-    for file_path in file_paths:
+    def run():
         try:
-            # Read audio file
-            data, samplerate = sf.read(file_path, dtype='float32')
-            if len(data.shape) == 1:
-                # Convert mono to stereo by duplicating the channel
-                data = np.stack((data, data), axis=1)
-            elif data.shape[1] == 1:
-                # Duplicate the channel to make it stereo
-                data = np.repeat(data, 2, axis=1)
-
-            duration = len(data) / samplerate
-
-            # Get labels
-            full_label = os.path.splitext(os.path.basename(file_path))[0]
-            # Replace hyphens and underscores with spaces
-            full_label_processed = full_label.replace('-', ' ').replace('_', ' ')
-            # Split into words
-            words = full_label_processed.split()
-            # Remove common words (case-insensitive)
-            label_words = [word for word in words if word.lower() not in [w.lower() for w in artist_track_name_words]]
-            label_without_common = ' '.join(label_words)
-            if not label_without_common.strip():
-                label_without_common = 'Track'
-
-            # Get track type information from JSON config
-            track_type_info = get_track_type(label_without_common, track_types)
-            icon_filename = track_type_info["icon"]
-            color = track_type_info["color"]
-            order_index = track_type_info.get("order", float('inf'))  # Use 'inf' if 'order' is missing
-
-            # Load icon image
-            icon_path = os.path.join(icon_location, icon_filename)
-            icon_image = pygame.image.load(icon_path).convert_alpha()
-            # Scale icon to fit in the box
-            icon_size = (64, 64)
-            icon_image = pygame.transform.smoothscale(icon_image, icon_size)
-
-            tracks.append({
-                'data': data,
-                'samplerate': samplerate,
-                'full_label': full_label,
-                'label_without_common': label_without_common,
-                'icon': icon_image,
-                'volume': 1.0,  # Initialize volume at 100%
-                'color': color,  # Store color from JSON
-                'order': order_index  # Include the 'order' key
-            })
-            mute_flags.append(False)  # Initially, all tracks are unmuted
-            if duration > max_duration:
-                max_duration = duration
+            if roots:
+                for root in roots:
+                    stem_library.scan(root, progress=report)
+            else:
+                stem_library.rescan_all(progress=report)
         except Exception as e:
-            print(f"Could not load sound file {file_path}: {e}")
-
-    # Sort tracks based on the 'order' value
-    tracks.sort(key=lambda t: t['order'])
-    total_duration = max_duration
-    playback_position = 0  # Reset playback position
+            print(f"Could not scan the library: {e}")
+
+    scan_state['thread'] = threading.Thread(target=run, daemon=True)
+    library_scan = scan_state
+    scan_state['thread'].start()
+
+def build_mix_peaks(session, dtype):
+    """Worker thread: build the slider's mix waveform once every stem of the session is cached."""
+    global mix_peaks
+    wait(session['load_jobs'])
+    session['mix_peaks'] = prepare_mix_peaks(session['tracks'], session['samplerate'], session['streamer'], dtype)
+    if session is current_session:
+        mix_peaks = session['mix_peaks']
+
+def open_output_stream():
+    """Open the session's output stream; it runs until the next load or exit, and pausing only silences it."""
+    global output_stream
+    try:
+        output_stream = open_output(args.output, session_samplerate, MIX_BLOCK_FRAMES, audio_callback,
+                                    args.output_file, args.realtime)
+        output_stream.start()
+    except Exception as e:
+        output_stream = None
+        print(f"Could not open the audio output: {e}")
+
+def close_output_stream():
+    """Stop playback and close the session's output stream."""
+    global output_stream, playing
     playing = False
+    if output_stream is not None:
+        output_stream.stop()
+        output_stream.close()
+        if args.output != 'sounddevice':
+            print(f"Output: {output_stream.frames / output_stream.samplerate:.1f} s rendered, "
+                  f"{output_stream.x_realtime():.0f}x realtime")
+        output_stream = None
+
+def toggle_playback():
+    """Play or pause. The stream is already running, so this takes effect on the next block."""
+    global playing
+    if playing:
+        playing = False
+    elif total_frames > 0:
+        if playback_frame >= total_frames:
+            # Start over after playing to the end
+            seek_to(0)
+        playing = True
+        if output_stream is not None and args.output != 'sounddevice':
+            output_stream.wake()  # The null and file outputs wait while paused
+
+def seek_to(frame):
+    """Move the transport to an exact frame; audio_callback hands the seek to the streamer."""
+    global seek_frame, playback_frame
+    seek_frame = max(0, min(int(frame), total_frames))
+    seek_event.set()
+    playback_frame = seek_frame
+
+def change_speed(step):
+    """Nudge the practice speed; the streaming thread picks it up within a few blocks."""
+    global playback_speed, queued_session
+    playback_speed = round(max(STRETCH_MIN_SPEED, min(1.0, playback_speed + step)), 2)
+    if streamer is not None:
+        streamer.set_speed(playback_speed)
+    upcoming = next_session
+    if upcoming is not None and upcoming['streamer'] is not None:
+        # The next song refills at the new speed before it is queued again
+        upcoming['streamer'].set_speed(playback_speed)
+        upcoming['refilled'] = False
+        if upcoming is queued_session:
+            queued_session = None
+
+def set_loop_point(point, frame):
+    """Set the loop start ('a') or end ('b'), dropping the other point if it is now on the wrong side."""
+    global loop_start, loop_end
+    if total_frames == 0:
+        return
+    frame = max(0, min(int(frame), total_frames))
+    if point == 'a':
+        loop_start = frame
+        if loop_end is not None and loop_end <= frame:
+            loop_end = None
+    else:
+        loop_end = frame
+        if loop_start is not None and loop_start >= frame:
+            loop_start = None
+    publish_loop()
+
+def clear_loop():
+    """Remove both loop points."""
+    global loop_start, loop_end
+    loop_start = None
+    loop_end = None
+    publish_loop()
+
+def publish_loop():
+    """Hand the current loop to audio_callback, jumping to the loop start if the playhead is outside it."""
+    global loop_region
+    if loop_start is not None and loop_end is not None:
+        loop_region = (loop_start, loop_end)
+        if not loop_start <= playback_frame < loop_end:
+            seek_to(loop_start)
+    else:
+        loop_region = None
+    loop_event.set()
+
+def get_font(size):
+    """Return the shared default font at the given size, creating it on first use."""
+    font = font_cache.get(size)
+    if font is None:
+        font = font_cache[size] = pygame.font.SysFont(None, size)
+    return font
+
+@lru_cache(maxsize=256)
+def render_text(text, size, color=(255, 255, 255)):
+    """Render a line of text once and reuse the surface while it stays on screen."""
+    return get_font(size).render(text, True, color)
 
 def draw_artist_track_name():
     """Function to draw the artist and track name above the track buttons."""
@@ -204,28 +647,33 @@ def draw_artist_track_name():
             display_text = display_text.replace('-', ' ').replace('_', ' ').title()
         else:
             display_text = display_text.replace('-', ' ').replace('_', ' ')
-        font = pygame.font.SysFont(None, 36)
-        text_surface = font.render(display_text, True, (255, 255, 255))
+        text_surface = render_text(display_text, 36)
         text_rect = text_surface.get_rect(center=(SCREEN_WIDTH // 2, MENU_BAR_HEIGHT + 30))
         screen.blit(text_surface, text_rect)
+        if len(playlist) > 1:
+            # Playlist position, and the next song once its stems have been labelled
+            position_text = f"Song {playlist_index + 1} of {len(playlist)}"
+            if next_session is not None and next_session['name']:
+                position_text += f", next: {next_session['name'].replace('-', ' ').replace('_', ' ')}"
+            text_surface = render_text(position_text, 18, (200, 200, 200))
+            screen.blit(text_surface, text_surface.get_rect(center=(SCREEN_WIDTH // 2, MENU_BAR_HEIGHT + 58)))
 
 def draw_menu_bar():
     """Function to draw the top menu bar."""
     # Draw menu bar background
     pygame.draw.rect(screen, (70, 70, 70), (0, 0, SCREEN_WIDTH, MENU_BAR_HEIGHT))
     # Draw "Load Tracks" button
-    font = pygame.font.SysFont(None, 24)
     button_padding = 10
 
     # Load Tracks Button
-    load_text = font.render("Load Tracks", True, (255, 255, 255))
+    load_text = render_text("Load Tracks", 24)
     load_text_width, load_text_height = load_text.get_size()
     load_button_rect = pygame.Rect(10, 5, load_text_width + button_padding * 2, load_text_height + button_padding)
     pygame.draw.rect(screen, (100, 100, 100), load_button_rect)
     screen.blit(load_text, (load_button_rect.x + button_padding, load_button_rect.y + button_padding // 2))
 
     # Settings Button
-    settings_text = font.render("Settings", True, (255, 255, 255))
+    settings_text = render_text("Settings", 24)
     settings_text_width, settings_text_height = settings_text.get_size()
     # Position settings button next to load tracks button
     settings_button_x = load_button_rect.right + 10  # 10 pixels gap
@@ -233,25 +681,41 @@ def draw_menu_bar():
     pygame.draw.rect(screen, (100, 100, 100), settings_button_rect)
     screen.blit(settings_text, (settings_button_rect.x + button_padding, settings_button_rect.y + button_padding // 2))
 
+    # Library Button
+    library_text = render_text("Library", 24)
+    library_button_rect = pygame.Rect(settings_button_rect.right + 10, 5, library_text.get_width() + button_padding * 2, load_text_height + button_padding)
+    pygame.draw.rect(screen, (100, 100, 100), library_button_rect)
+    screen.blit(library_text, (library_button_rect.x + button_padding, library_button_rect.y + button_padding // 2))
+
+    # Cache pre-warm and library scan status
+    pending_warm_jobs = sum(not job.done() for job in warm_jobs)
+    status = None
+    if library_scan is not None and library_scan['thread'].is_alive():
+        status = f"Scanning library {library_scan['progress']:.0%}..."
+    elif pending_warm_jobs:
+        status = f"Caching {pending_warm_jobs} stems..."
+    if status:
+        status_text = render_text(status, 24, (200, 200, 200))
+        screen.blit(status_text, status_text.get_rect(midright=(SCREEN_WIDTH - 10, MENU_BAR_HEIGHT // 2)))
+
     # Store button rects for interaction
     ui_elements['load_button_rect'] = load_button_rect
     ui_elements['settings_button_rect'] = settings_button_rect
+    ui_elements['library_button_rect'] = library_button_rect
 
 def draw_settings_menu():
     """Function to draw the settings menu."""
     menu_width = 300
-    menu_height = 200
+    menu_height = 240
     x = (SCREEN_WIDTH - menu_width) // 2
     y = (SCREEN_HEIGHT - menu_height) // 2
     # Draw menu background
     pygame.draw.rect(screen, (60, 60, 60), (x, y, menu_width, menu_height))
     pygame.draw.rect(screen, (255, 255, 255), (x, y, menu_width, menu_height), 2)  # Border
 
-    font = pygame.font.SysFont(None, 24)
-
     # Option 1: Toggle Title Visibility
     title_text = "Show Title"
-    title_label = font.render(title_text, True, (255, 255, 255))
+    title_label = render_text(title_text, 24)
     title_checkbox_rect = pygame.Rect(x + 20, y + 30, 20, 20)
     pygame.draw.rect(screen, (255, 255, 255), title_checkbox_rect, 2)
     if show_title:
@@ -260,7 +724,7 @@ def draw_settings_menu():
 
     # Option 2: Toggle Full Track Labels
     full_label_text = "Show Full Track Labels"
-    full_label_label = font.render(full_label_text, True, (255, 255, 255))
+    full_label_label = render_text(full_label_text, 24)
     full_label_checkbox_rect = pygame.Rect(x + 20, y + 70, 20, 20)
     pygame.draw.rect(screen, (255, 255, 255), full_label_checkbox_rect, 2)
     if show_full_labels:
@@ -269,17 +733,87 @@ def draw_settings_menu():
 
     # Option 3: Show Raw or Title Case Labels
     label_case_text = "Use Title Case Labels"
-    label_case_label = font.render(label_case_text, True, (255, 255, 255))
+    label_case_label = render_text(label_case_text, 24)
     label_case_checkbox_rect = pygame.Rect(x + 20, y + 110, 20, 20)
     pygame.draw.rect(screen, (255, 255, 255), label_case_checkbox_rect, 2)
     if use_title_case_labels:
         pygame.draw.rect(screen, (255, 255, 255), label_case_checkbox_rect.inflate(-4, -4))
     screen.blit(label_case_label, (label_case_checkbox_rect.right + 10, label_case_checkbox_rect.y))
 
+    # Option 4: Session sample rate (applies to the next load)
+    device_rate_text = "Match Output Device Rate"
+    device_rate_label = render_text(device_rate_text, 24)
+    device_rate_checkbox_rect = pygame.Rect(x + 20, y + 150, 20, 20)
+    pygame.draw.rect(screen, (255, 255, 255), device_rate_checkbox_rect, 2)
+    if match_device_samplerate:
+        pygame.draw.rect(screen, (255, 255, 255), device_rate_checkbox_rect.inflate(-4, -4))
+    screen.blit(device_rate_label, (device_rate_checkbox_rect.right + 10, device_rate_checkbox_rect.y))
+
+    # Option 5: 16-bit audio cache (applies to the next load)
+    compact_cache_label = render_text("16-bit Audio Cache", 24)
+    compact_cache_checkbox_rect = pygame.Rect(x + 20, y + 190, 20, 20)
+    pygame.draw.rect(screen, (255, 255, 255), compact_cache_checkbox_rect, 2)
+    if compact_cache:
+        pygame.draw.rect(screen, (255, 255, 255), compact_cache_checkbox_rect.inflate(-4, -4))
+    screen.blit(compact_cache_label, (compact_cache_checkbox_rect.right + 10, compact_cache_checkbox_rect.y))
+
     # Store checkbox rects for interaction
     ui_elements['title_checkbox_rect'] = title_checkbox_rect
     ui_elements['full_label_checkbox_rect'] = full_label_checkbox_rect
     ui_elements['label_case_checkbox_rect'] = label_case_checkbox_rect
+    ui_elements['device_rate_checkbox_rect'] = device_rate_checkbox_rect
+    ui_elements['compact_cache_checkbox_rect'] = compact_cache_checkbox_rect
+
+def draw_library_browser():
+    """Draw the library browser: a search line, matching songs and buttons to add or rescan folders."""
+    width, height = 900, 560
+    x = (SCREEN_WIDTH - width) // 2
+    y = MENU_BAR_HEIGHT + 40
+    row_height = 28
+    pygame.draw.rect(screen, (40, 40, 40), (x, y, width, height))
+    pygame.draw.rect(screen, (255, 255, 255), (x, y, width, height), 2)  # Border
+
+    # Search line
+    search_rect = pygame.Rect(x + 20, y + 20, width - 300, 32)
+    pygame.draw.rect(screen, (20, 20, 20), search_rect)
+    pygame.draw.rect(screen, (255, 255, 255), search_rect, 1)
+    query_text = render_text(library_query + "_", 24) if library_query else render_text("Type to search the library", 24, (140, 140, 140))
+    screen.blit(query_text, (search_rect.x + 8, search_rect.centery - query_text.get_height() // 2))
+
+    # Add Folder and Rescan buttons
+    button_x = search_rect.right + 10
+    for key, label in (('library_add_rect', "Add Folder"), ('library_rescan_rect', "Rescan")):
+        text = render_text(label, 24)
+        button_rect = pygame.Rect(button_x, search_rect.y, text.get_width() + 20, search_rect.height)
+        pygame.draw.rect(screen, (100, 100, 100), button_rect)
+        screen.blit(text, text.get_rect(center=button_rect.center))
+        ui_elements[key] = button_rect
+        button_x = button_rect.right + 10
+
+    # Songs, scrolled to keep the selection in view
+    list_top = search_rect.bottom + 15
+    visible_rows = (y + height - 30 - list_top) // row_height
+    first = max(0, min(library_selection - visible_rows // 2, len(library_results) - visible_rows))
+    rows = []
+    for offset, (song_id, name, directory, stem_count, duration) in enumerate(library_results[first:first + visible_rows]):
+        index = first + offset
+        row_rect = pygame.Rect(x + 10, list_top + offset * row_height, width - 20, row_height)
+        if index == library_selection:
+            pygame.draw.rect(screen, (0, 120, 0), row_rect)
+        screen.blit(render_text(name, 22), (row_rect.x + 10, row_rect.y + 5))
+        details = f"{stem_count} stems  {int(duration) // 60:02d}:{int(duration) % 60:02d}"
+        screen.blit(render_text(details, 20, (200, 200, 200)), (row_rect.x + 430, row_rect.y + 6))
+        screen.blit(render_text(os.path.basename(directory), 20, (160, 160, 160)), (row_rect.x + 580, row_rect.y + 6))
+        rows.append((index, row_rect))
+    if not library_results:
+        empty = "No matching songs" if library_query else "The library is empty. Use Add Folder to scan your stems."
+        screen.blit(render_text(empty, 22, (200, 200, 200)), (x + 20, list_top + 5))
+    footer = f"{len(library_results)}{'+' if len(library_results) == stem_library.SEARCH_LIMIT else ''} songs  -  Enter opens, Esc closes"
+    screen.blit(render_text(footer, 20, (160, 160, 160)), (x + 20, y + height - 26))
+
+    # Store rects for interaction
+    ui_elements['library_rect'] = pygame.Rect(x, y, width, height)
+    ui_elements['library_rows'] = rows
 
 def draw_play_pause_button():
     """Function to draw the play/pause button."""
@@ -293,17 +827,47 @@ def draw_play_pause_button():
     # Store button rect for interaction
     ui_elements['play_button_rect'] = play_button_rect
 
-def draw_timecode():
-    """Function to display the current playback time and total duration."""
+def timecode_text():
+    """Current playback time and total duration, as shown under the slider."""
     if total_duration == 0:
-        return
-    font = pygame.font.SysFont(None, 24)
-    current_minutes = int(playback_position) // 60
-    current_seconds = int(playback_position) % 60
+        return ""
+    position = playback_frame // session_samplerate
+    current_minutes = position // 60
+    current_seconds = position % 60
     total_minutes = int(total_duration) // 60
     total_seconds = int(total_duration) % 60
     timecode_text = f"{current_minutes:02d}:{current_seconds:02d} / {total_minutes:02d}:{total_seconds:02d}"
-    timecode_surface = font.render(timecode_text, True, (255, 255, 255))
+    if playback_speed != 1.0:
+        timecode_text += f"  ({playback_speed:.0%} speed)"
+    return timecode_text
+
+def update_limiter_meter(now):
+    """Follow the limiter's gain reduction: rise instantly, fall at LIMITER_METER_FALL_DB_PER_S."""
+    elapsed = now - limiter_meter['time']
+    limiter_meter['time'] = now
+    limiter_meter['db'] = max(limiter.reduction_db, limiter_meter['db'] - LIMITER_METER_FALL_DB_PER_S * elapsed, 0.0)
+
+def limiter_meter_pixels():
+    """Width of the gain reduction bar and its label, as drawn by draw_limiter_meter()."""
+    reduction = min(limiter_meter['db'], LIMITER_METER_RANGE_DB)
+    width = int(LIMITER_METER_AREA.width * reduction / LIMITER_METER_RANGE_DB)
+    return width, f"-{reduction:.1f} dB" if width else ""
+
+def draw_limiter_meter():
+    """Bar growing from the left with the limiter's gain reduction, beside the play button."""
+    width, label = limiter_meter_pixels()
+    bar = pygame.Rect(LIMITER_METER_AREA.x, LIMITER_METER_AREA.centery - 4, LIMITER_METER_AREA.width, 8)
+    pygame.draw.rect(screen, (20, 20, 20), bar)
+    if width:
+        pygame.draw.rect(screen, (220, 40, 40), (bar.x, bar.y, width, bar.height))
+        screen.blit(render_text(label, 18), (bar.x, bar.bottom + 4))
+    screen.blit(render_text("Limiter", 18), (bar.x, bar.y - 18))
+
+def draw_timecode():
+    """Function to display the current playback time and total duration."""
+    if total_duration == 0:
+        return
+    timecode_surface = render_text(timecode_text(), 24)
     timecode_rect = timecode_surface.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT - 50))
     screen.blit(timecode_surface, timecode_rect)
 
@@ -323,11 +887,138 @@ def recolor_icon(icon_image, color):
 
     return tinted_icon
 
-def draw_tracks():
-    """Function to draw icon boxes for each track."""
+def layout_label(label, text_color, box_width, box_height, icon_height, max_font_size=24, min_font_size=12):
+    """Wrap a track label to the box width and shrink it until it fits under the icon.
+
+    Measures with font.size() and renders each line once at the final size.
+    """
+    # Wrap text to fit within the box width
+    font_size = max_font_size
+    font = get_font(font_size)
+    words = label.split()
+    lines = []
+    current_line = ''
+    for word in words:
+        test_line = f"{current_line} {word}".strip()
+        if font.size(test_line)[0] <= box_width - 10:
+            current_line = test_line
+        else:
+            if current_line:
+                lines.append(current_line)
+            current_line = word
+    if current_line:
+        lines.append(current_line)
+
+    # Adjust font size if text is too tall
+    while True:
+        font = get_font(font_size)
+        total_text_height = sum(font.size(line)[1] for line in lines)
+        total_height = total_text_height + icon_height + 20  # Include icon height
+        if total_height > box_height - 10 and font_size > min_font_size:
+            font_size -= 1
+        else:
+            break
+
+    return [font.render(line, True, text_color) for line in lines]
+
+def waveform_surface(levels, width, height, color):
+    """Render a peak pyramid as one vertical line per pixel column on a transparent surface."""
+    surface = pygame.Surface((width, height), pygame.SRCALPHA)
+    if not len(levels[0]):
+        return surface
+    lows, highs = peak_columns(levels, width)
+    middle = (height - 1) / 2
+    tops = np.rint(middle - np.clip(highs, -1, 1) * middle).astype(int).tolist()
+    bottoms = np.rint(middle - np.clip(lows, -1, 1) * middle).astype(int).tolist()
+    for x, (top, bottom) in enumerate(zip(tops, bottoms)):
+        pygame.draw.line(surface, color, (x, top), (x, bottom))
+    return surface
+
+def track_render_cache(track, muted, box_width, box_height):
+    """Return a track's cached surfaces, rebuilding only the parts whose inputs changed.
+
+    Holds the icon tinted for the active and muted states, the laid-out label
+    (keyed on the label settings and mute state), the volume overlay (keyed on
+    its height) and the waveform (drawn once the stem's peaks arrive).
+    """
+    cache = track.setdefault('render', {})
+    if 'icons' not in cache:
+        # Active tracks show a white icon, inactive ones a black icon
+        icon = load_icon(track['icon_filename'])
+        cache['icons'] = {False: recolor_icon(icon, [255, 255, 255]),
+                          True: recolor_icon(icon, [0, 0, 0])}
+
+    label_key = (show_full_labels, use_title_case_labels, muted)
+    if cache.get('label_key') != label_key:
+        # Select label based on settings
+        label = track['full_label'] if show_full_labels else track['label_without_common']
+        label = (label.replace('-', ' ').replace('_', ' ').title() if use_title_case_labels
+                 else label.replace('-', ' ').replace('_', ' '))
+        # Determine text color based on whether the track is active or inactive
+        text_color = (255, 255, 255) if not muted else (0, 0, 0)
+        cache['label'] = layout_label(label, text_color, box_width, box_height, cache['icons'][muted].get_height())
+        cache['label_key'] = label_key
+
+    overlay_height = int(box_height * (1 - track['volume']))
+    if cache.get('overlay_height') != overlay_height:
+        cache['overlay'] = None
+        if overlay_height > 0:
+            cache['overlay'] = pygame.Surface((box_width, overlay_height), pygame.SRCALPHA)
+            cache['overlay'].fill((128, 128, 128, 128))  # Gray with 50% opacity
+        cache['overlay_height'] = overlay_height
+
+    if track['peaks'] is not None and cache.get('waveform_peaks') is not track['peaks']:
+        cache['waveform'] = waveform_surface(track['peaks'], box_width, TRACK_WAVEFORM_HEIGHT, (255, 255, 255, 70))
+        cache['waveform_peaks'] = track['peaks']
+    return cache
+
+def update_meter(track, peak, rms, now):
+    """Smooth one track's meter: rise instantly, fall at METER_FALL_DB_PER_S, hold the peak."""
+    elapsed = now - track.get('meter_time', now)
+    track['meter_time'] = now
+    fall = METER_FALL_DB_PER_S * elapsed
+    rms_db = 20 * np.log10(max(rms, 1e-6))
+    peak_db = 20 * np.log10(max(peak, 1e-6))
+    track['rms_db'] = max(rms_db, track.get('rms_db', METER_FLOOR_DB) - fall, METER_FLOOR_DB)
+    track['peak_db'] = max(peak_db, track.get('peak_db', METER_FLOOR_DB) - fall, METER_FLOOR_DB)
+    if 'hold_db' not in track or peak_db >= track['hold_db'] or now - track['hold_time'] > METER_PEAK_HOLD_S:
+        track['hold_db'] = max(peak_db, METER_FLOOR_DB)
+        track['hold_time'] = now
+
+def meter_pixels(track, height):
+    """Peak bar, RMS bar and held peak heights of a track's meter in pixels, and whether the peak reached full scale."""
+    def scale(level):
+        return int(height * (1 - min(level, 0) / METER_FLOOR_DB))
+    return scale(track['peak_db']), scale(track['rms_db']), scale(track['hold_db']), track['hold_db'] > -0.1
+
+def meters_falling():
+    """True while any track's meter or held peak is still above the floor."""
+    return any(track.get('peak_db', METER_FLOOR_DB) > METER_FLOOR_DB or track.get('hold_db', METER_FLOOR_DB) > METER_FLOOR_DB
+               for track in tracks)
+
+def draw_meter(rect, pixels):
+    """Draw a track's peak bar, RMS bar and held peak line from meter_pixels()."""
+    peak_height, rms_height, hold_height, clipped = pixels
+    pygame.draw.rect(screen, (20, 20, 20), rect)
+    for height, color in ((peak_height, (150, 150, 150)), (rms_height, (255, 255, 255))):
+        if height > 0:
+            pygame.draw.rect(screen, color, (rect.x, rect.bottom - height, rect.width, height))
+    if hold_height > 0:
+        hold_y = max(rect.y, rect.bottom - hold_height)
+        # Red once the stem reaches full scale
+        hold_color = (255, 60, 60) if clipped else (255, 255, 255)
+        pygame.draw.line(screen, hold_color, (rect.x, hold_y), (rect.right - 1, hold_y), 2)
+
+def draw_tracks(only_changed=False):
+    """Function to draw icon boxes for each track.
+
+    With only_changed, boxes that would look the same as when they were last
+    drawn are skipped. Returns the rects of the boxes drawn.
+    """
     num_tracks = len(tracks)
+    drawn = []
     if num_tracks == 0:
-        return
+        return drawn
 
     box_width = 150
     box_height = 150
@@ -335,10 +1026,9 @@ def draw_tracks():
     start_x = padding
     # Adjust y_offset based on whether the title is shown
     y_offset = MENU_BAR_HEIGHT + 70 if show_title else MENU_BAR_HEIGHT + 20  # Start below the menu bar and artist name
-    max_font_size = 24
-    min_font_size = 12
     columns = max(1, (SCREEN_WIDTH - padding * 2) // (box_width + padding))
     rows = (num_tracks + columns - 1) // columns
+    now = perf_counter()
 
     for idx, track in enumerate(tracks):
         row = idx // columns
@@ -347,90 +1037,152 @@ def draw_tracks():
         current_y = y_offset + row * (box_height + padding)
         rect = pygame.Rect(x, current_y, box_width, box_height)
         track['rect'] = rect  # Store rect in track dict
+        muted = mute_flags[idx]
+        render = track_render_cache(track, muted, box_width, box_height)
+
+        # Meters may still belong to the previous session
+        meter_rect = pygame.Rect(x + box_width - 10, current_y + 6, 5, box_height - 12)
+        pixels = None
+        if idx < len(meters.peak):
+            update_meter(track, float(meters.peak[idx]), float(meters.rms[idx]), now)
+            pixels = meter_pixels(track, meter_rect.height)
+        loading = not track['ready'] and not track.get('failed')
+        bar_rect = pygame.Rect(x + 10, current_y + box_height - 14, box_width - 20, 6)
+        progress_width = int(bar_rect.width * track['progress']) if loading else -1
+        # Everything the box's pixels depend on
+        key = (rect.topleft, muted, render['label_key'], render['overlay_height'], render.get('waveform_peaks') is not None,
+               rmb_pressed and idx == soloed_track_idx, pixels, progress_width)
+        if only_changed and track.get('drawn_key') == key:
+            continue
+        track['drawn_key'] = key
+        drawn.append(rect)
 
         # Get color from track data
         color = track['color']
-        if mute_flags[idx]:
+        if muted:
             color = [max(0, c - 50) for c in color]  # Darken color if muted
 
         # Draw background
         pygame.draw.rect(screen, color, rect)
 
+        # Draw the stem's waveform along the bottom of the box
+        if 'waveform' in render:
+            screen.blit(render['waveform'], (x, current_y + box_height - TRACK_WAVEFORM_HEIGHT))
+
         # If this track is soloed, draw a thick white outline
         if rmb_pressed and idx == soloed_track_idx:
             pygame.draw.rect(screen, (255, 255, 255), rect, 7)  # 7 pixels thick
 
-        # Draw icon
-        icon_image = track['icon']
-        icon_rect = icon_image.get_rect(center=(x + box_width // 2, current_y + 40))
-
-        # Tint the icon based on whether the track is active or inactive
-        if not mute_flags[idx]:
-            # Active track: recolor the icon to white
-            tinted_icon = recolor_icon(icon_image, [255, 255, 255])
-        else:
-            # Inactive track: recolor the icon to black
-            tinted_icon = recolor_icon(icon_image, [0, 0, 0])
-
+        # Draw the icon tinted for the track's state
+        tinted_icon = render['icons'][muted]
+        icon_rect = tinted_icon.get_rect(center=(x + box_width // 2, current_y + 40))
         screen.blit(tinted_icon, icon_rect)
 
-        # Select label based on settings
-        label = track['full_label'] if show_full_labels else track['label_without_common']
-        label = (label.replace('-', ' ').replace('_', ' ').title() if use_title_case_labels
-                 else label.replace('-', ' ').replace('_', ' '))
-
-        # Determine text color based on whether the track is active or inactive
-        text_color = (255, 255, 255) if not mute_flags[idx] else (0, 0, 0)
-
-        # Wrap text to fit within the box width
-        font_size = max_font_size
-        font = pygame.font.SysFont(None, font_size)
-        words = label.split()
-        lines = []
-        current_line = ''
-        for word in words:
-            test_line = f"{current_line} {word}".strip()
-            test_surface = font.render(test_line, True, text_color)
-            if test_surface.get_width() <= box_width - 10:
-                current_line = test_line
-            else:
-                if current_line:
-                    lines.append(current_line)
-                current_line = word
-        if current_line:
-            lines.append(current_line)
-
-        # Adjust font size if text is too tall
-        while True:
-            font = pygame.font.SysFont(None, font_size)
-            text_surfaces = [font.render(line, True, text_color) for line in lines]
-            total_text_height = sum(text.get_height() for text in text_surfaces)
-            total_height = total_text_height + icon_rect.height + 20  # Include icon height
-            if total_height > box_height - 10 and font_size > min_font_size:
-                font_size -= 1
-            else:
-                break
-
-        # Re-render text surfaces with the adjusted font size
-        font = pygame.font.SysFont(None, font_size)
-        text_surfaces = [font.render(line, True, text_color) for line in lines]
-
         # Calculate starting y-coordinate to place the label below the icon
         label_y = icon_rect.bottom + 5
-        for text in text_surfaces:
+        for text in render['label']:
             text_rect = text.get_rect(centerx=x + box_width // 2, y=label_y)
             screen.blit(text, text_rect)
             label_y += text.get_height()
 
         # Draw volume overlay
-        volume = track['volume']
-        overlay_height = box_height * (1 - volume)
-        if overlay_height > 0:
-            overlay = pygame.Surface((box_width, overlay_height), pygame.SRCALPHA)
-            overlay.fill((128, 128, 128, 128))  # Gray with 50% opacity
+        if render['overlay'] is not None:
             overlay_y = current_y  # Start from the top
-            screen.blit(overlay, (x, overlay_y))
-
+            screen.blit(render['overlay'], (x, overlay_y))
+
+        # Draw the level meter along the right edge
+        if pixels is not None:
+            draw_meter(meter_rect, pixels)
+
+        # Draw load progress until the stem can play
+        if loading:
+            pygame.draw.rect(screen, (40, 40, 40), bar_rect)
+            pygame.draw.rect(screen, (255, 255, 255), (bar_rect.x, bar_rect.y, progress_width, bar_rect.height))
+    return drawn
+
+def draw_telemetry_overlay():
+    """Draw audio_callback's load histogram and xrun counters in the top-right corner."""
+    width, height = 280, 190
+    x = SCREEN_WIDTH - width - 10
+    y = MENU_BAR_HEIGHT + 10
+    panel = pygame.Rect(x, y, width, height)
+    pygame.draw.rect(screen, (20, 20, 20), panel)
+    pygame.draw.rect(screen, (255, 255, 255), panel, 1)
+
+    telemetry = callback_telemetry()
+    stats = telemetry.summary()
+    latest = telemetry.recent[(telemetry.blocks - 1) % len(telemetry.recent)] if telemetry.blocks else 0.0
+    lines = [
+        f"Callback load {latest:.0%}  max {stats['max_load']:.0%}",
+        f"Underflows {stats['underflows']}  overflows {stats['overflows']}",
+        f"Missed deadlines {stats['missed_deadlines']} / {stats['blocks']} blocks",
+        f"UI {frame_stats['draw_ms']:.1f} ms/frame, {frame_stats['fps']:.0f} fps, CPU {frame_stats['cpu']:.0%}",
+    ]
+    text_y = y + 6
+    for line in lines:
+        text = render_text(line, 20)
+        screen.blit(text, (x + 8, text_y))
+        text_y += text.get_height() + 2
+
+    # Histogram of load across the block period; the red bar is blocks over the deadline
+    histogram = telemetry.histogram
+    peak = max(int(histogram.max()), 1)
+    chart_top = text_y + 6
+    chart_height = y + height - 8 - chart_top
+    bar_width = (width - 16) // len(histogram)
+    for i, count in enumerate(histogram):
+        bar_height = int(chart_height * count / peak)
+        if i == len(histogram) - 1:
+            color = (220, 40, 40)
+        elif i < len(histogram) // 2:
+            color = (0, 200, 0)
+        else:
+            color = (220, 200, 0)
+        pygame.draw.rect(screen, color, (x + 8 + i * bar_width, chart_top + chart_height - bar_height, bar_width - 1, bar_height))
+
+def format_bytes(count):
+    """Human-readable size, such as 12.5 MB."""
+    for unit in ('B', 'KB', 'MB'):
+        if count < 1024:
+            return f"{count:.0f} {unit}" if unit == 'B' else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.2f} GB"
+
+def draw_memory_overlay():
+    """Draw the memory held for each stem and for the session in the top-left corner."""
+    budget = memory_budget(tracks, streamer)
+    rows = []
+    for track, usage in zip(tracks, budget):
+        layout = "mono" if track['channels'] == 1 else f"{track['channels']} ch"
+        data_format = track['data'].dtype.name if track.get('data') is not None else "streaming"
+        rows.append((track['label_without_common'][:24], layout, data_format,
+                     format_bytes(usage['audio'] + usage['buffers'] + usage['peaks'])))
+    audio = sum(usage['audio'] for usage in budget)
+    buffers = sum(usage['buffers'] for usage in budget)
+    peaks = sum(usage['peaks'] for usage in budget)
+    rows.append((f"Total (audio {format_bytes(audio)}, buffers {format_bytes(buffers)})", "", "",
+                 format_bytes(audio + buffers + peaks)))
+    upcoming = next_session
+    if upcoming is not None and upcoming['streamer'] is not None:
+        # The preloaded next song is the only other session held in memory
+        upcoming_budget = memory_budget(upcoming['tracks'], upcoming['streamer'])
+        rows.append((f"Next song ({len(upcoming['tracks'])} stems)", "", "",
+                     format_bytes(sum(sum(usage.values()) for usage in upcoming_budget))))
+
+    width, line_height = 440, 18
+    x, y = 10, MENU_BAR_HEIGHT + 10
+    panel = pygame.Rect(x, y, width, line_height * len(rows) + 12)
+    pygame.draw.rect(screen, (20, 20, 20), panel)
+    pygame.draw.rect(screen, (255, 255, 255), panel, 1)
+    font = get_font(18)
+    for i, (label, layout, data_format, size) in enumerate(rows):
+        # Sizes change while stems load, so these aren't worth caching in render_text
+        row_y = y + 6 + i * line_height
+        screen.blit(font.render(label, True, (255, 255, 255)), (x + 8, row_y))
+        screen.blit(font.render(layout, True, (255, 255, 255)), (x + 230, row_y))
+        screen.blit(font.render(data_format, True, (255, 255, 255)), (x + 290, row_y))
+        size_text = font.render(size, True, (255, 255, 255))
+        screen.blit(size_text, (x + width - 8 - size_text.get_width(), row_y))
 
 def draw_playback_slider():
     """Function to draw the playback slider at the bottom."""
@@ -444,82 +1196,287 @@ def draw_playback_slider():
     # Draw slider background
     pygame.draw.rect(screen, (100, 100, 100), (x, y, slider_width, slider_height))
     # Draw playback progress
-    progress = playback_position / total_duration
+    progress = playback_frame / total_frames
     progress_width = int(slider_width * progress)
     pygame.draw.rect(screen, (0, 200, 0), (x, y, progress_width, slider_height))
+    # Draw the mix waveform over it once it has been built
+    if mix_peaks is not None:
+        if mix_render.get('peaks') is not mix_peaks or mix_render.get('size') != (slider_width, slider_height):
+            mix_render['surface'] = waveform_surface(mix_peaks, slider_width, slider_height, (255, 255, 255, 150))
+            mix_render['peaks'] = mix_peaks
+            mix_render['size'] = (slider_width, slider_height)
+        screen.blit(mix_render['surface'], (x, y))
+    # Shade the A/B loop and mark its points
+    marks = [frame for frame in (loop_start, loop_end) if frame is not None]
+    if len(marks) == 2:
+        loop_x = x + slider_width * loop_start // total_frames
+        loop_width = slider_width * loop_end // total_frames - (loop_x - x)
+        shade_size = (max(1, loop_width), slider_height)
+        if mix_render.get('shade_size') != shade_size:
+            # Only rebuilt when the loop points move
+            mix_render['shade'] = pygame.Surface(shade_size, pygame.SRCALPHA)
+            mix_render['shade'].fill((255, 200, 0, 70))
+            mix_render['shade_size'] = shade_size
+        screen.blit(mix_render['shade'], (loop_x, y))
+    for frame in marks:
+        mark_x = x + slider_width * frame // total_frames
+        pygame.draw.line(screen, (255, 200, 0), (mark_x, y - 4), (mark_x, y + slider_height + 3), 2)
     # Store slider rect for interaction
     ui_elements['slider_rect'] = pygame.Rect(x, y, slider_width, slider_height)
 
-def audio_callback(outdata, frames, time, status):
-    """Callback function for sounddevice.OutputStream."""
-    global playback_position, total_duration, tracks, mute_flags, stop_event, seek_event, seek_position
-    if status.output_underflow:
-        print('Output underflow: increase blocksize?', file=sys.stderr)
-        raise sd.CallbackAbort
-    if stop_event.is_set():
-        raise sd.CallbackStop
+def select_visualizer_track(pos):
+    """Analyse the track under pos in the visualizer, or the mix again if it is already selected or pos misses."""
+    global visualizer_track
+    hovered = next((i for i, track in enumerate(tracks) if 'rect' in track and track['rect'].collidepoint(pos)), None)
+    visualizer_track = None if hovered == visualizer_track else hovered
+
+def draw_visualizer():
+    """Draw the spectrogram or spectrum bars of the mix or the selected stem above the transport.
 
+    Columns are computed by a SpectrogramWorker from the decoded stems; each frame
+    only the columns it finished since the last frame are written into a ring-buffer
+    texture, which is blitted in two pieces so the newest column is on the right.
+    """
+    global spectrogram
+    if total_duration == 0:
+        return
+    width, height = SCREEN_WIDTH - 100, VISUALIZER_HEIGHT
+    x, y = 50, SCREEN_HEIGHT - 160 - height
+    if spectrogram is None:
+        spectrogram = SpectrogramWorker(session_samplerate, height, width)
+
+    # Stems still streaming from their files have no decoded data yet and are left out
+    if visualizer_track is None:
+        picked = [i for i, track in enumerate(tracks) if track.get('data') is not None]
+        gains = mix_gains[picked]
+    else:
+        picked = [visualizer_track] if tracks[visualizer_track].get('data') is not None else []
+        gains = np.ones(len(picked), dtype='float32')
+    spectrogram.follow(playback_frame, [tracks[i]['data'] for i in picked], gains)
+
+    if 'texture' not in spectrogram_render:
+        spectrogram_render['texture'] = pygame.Surface((width, height), 0, 32)
+        spectrogram_render['texture'].fill((0, 0, 0))
+        spectrogram_render['written'] = 0
+        spectrogram_render['latest'] = np.full(height, SPECTRUM_FLOOR_DB, dtype='float32')
+    texture = spectrogram_render['texture']
+    while spectrogram.ready:
+        _, levels = spectrogram.ready.popleft()
+        levels = levels[-width:]
+        spectrogram_render['latest'] = levels[-1]
+        # Low frequencies at the bottom
+        shade = np.clip((levels[:, ::-1] - SPECTRUM_FLOOR_DB) * (255 / -SPECTRUM_FLOOR_DB), 0, 255).astype(np.uint8)
+        columns = (spectrogram_render['written'] + np.arange(len(levels))) % width
+        pixels = pygame.surfarray.pixels3d(texture)
+        pixels[columns] = SPECTROGRAM_PALETTE[shade]
+        del pixels  # Unlock the surface
+        spectrogram_render['written'] += len(levels)
+
+    panel = pygame.Rect(x, y, width, height)
+    if visualizer_mode == 'spectrogram':
+        split = spectrogram_render['written'] % width
+        screen.blit(texture, (x, y), (split, 0, width - split, height))
+        screen.blit(texture, (x + width - split, y), (0, 0, split, height))
+    else:
+        pygame.draw.rect(screen, (0, 0, 0), panel)
+        latest = spectrogram_render['latest']
+        bands = latest[:len(latest) - len(latest) % VISUALIZER_BARS].reshape(VISUALIZER_BARS, -1).max(axis=1)
+        bar_width = width // VISUALIZER_BARS
+        for i, level in enumerate(bands):
+            shade = int(np.clip((level - SPECTRUM_FLOOR_DB) * (255 / -SPECTRUM_FLOOR_DB), 0, 255))
+            bar_height = height * shade // 255
+            pygame.draw.rect(screen, SPECTROGRAM_PALETTE[shade],
+                             (x + i * bar_width, y + height - bar_height, bar_width - 2, bar_height))
+    pygame.draw.rect(screen, (255, 255, 255), panel, 1)
+
+    source = "Mix" if visualizer_track is None else tracks[visualizer_track]['label_without_common']
+    screen.blit(render_text(f"{visualizer_mode.title()}: {source}", 20), (x + 8, y + 6))
+
+def needs_animation():
+    """True while something on screen changes by itself: playback, loading, falling meters or a library scan."""
+    return (playing or meters_falling() or limiter_meter['db'] > 0 or (library_open and library_scan is not None)
+            or any(not track['ready'] and not track.get('failed') for track in tracks))
+
+def overlays_open():
+    """True while a panel drawn over other parts of the window is showing."""
+    return settings_menu_open or library_open or show_telemetry or show_memory or visualizer_mode is not None
+
+def transport_keys():
+    """State the play button, slider, timecode and limiter meter are drawn from, to tell when they need redrawing."""
+    progress = SCREEN_WIDTH * playback_frame // total_frames if total_frames else 0
+    return {'play': playing,
+            'slider': (progress, total_frames, loop_start, loop_end, mix_peaks is not None),
+            'timecode': timecode_text(),
+            'limiter': limiter_meter_pixels()}
+
+def draw_frame():
+    """Draw the whole window."""
+    global library_scan
+    screen.fill(BACKGROUND_COLOR)
+    draw_menu_bar()
+    if show_title:
+        draw_artist_track_name()
+    draw_tracks()
+    draw_play_pause_button()
+    draw_playback_slider()
+    draw_timecode()
+    draw_limiter_meter()
+    drawn_keys.update(transport_keys())
+    if visualizer_mode is not None:
+        draw_visualizer()
+    if settings_menu_open:
+        draw_settings_menu()
+    if library_open:
+        # Pick up songs added by a scan that finished since the last search
+        if library_scan is not None and not library_scan['thread'].is_alive():
+            library_scan = None
+            search_library(library_query)
+        draw_library_browser()
+    if show_telemetry:
+        draw_telemetry_overlay()
+    if show_memory:
+        draw_memory_overlay()
+
+def draw_playback_changes():
+    """Redraw only the track boxes and transport areas whose state changed; returns the rects to update."""
+    rects = draw_tracks(only_changed=True)
+    keys = transport_keys()
+    for name, area, draw in (('play', PLAY_BUTTON_AREA, draw_play_pause_button),
+                             ('slider', SLIDER_AREA, draw_playback_slider),
+                             ('timecode', TIMECODE_AREA, draw_timecode),
+                             ('limiter', LIMITER_METER_AREA, draw_limiter_meter)):
+        if keys[name] != drawn_keys.get(name):
+            screen.fill(BACKGROUND_COLOR, area)
+            draw()
+            rects.append(area)
+    drawn_keys.update(keys)
+    return rects
+
+def record_frame(draw_time):
+    """Track how long frames take to draw, the frame rate and the process's CPU use, updated once a second."""
+    frame_stats['draw_ms'] += (draw_time * 1e3 - frame_stats['draw_ms']) * 0.1
+    frame_stats['frames'] += 1
+    now = perf_counter()
+    elapsed = now - frame_stats['since']
+    if elapsed >= 1.0:
+        cpu = process_time()
+        # CPU of every thread, audio and loading included, as a fraction of one core
+        frame_stats['cpu'] = (cpu - frame_stats['cpu_since']) / elapsed
+        frame_stats['fps'] = frame_stats['frames'] / elapsed
+        frame_stats.update(frames=0, since=now, cpu_since=cpu)
+
+def update_mix_gains():
+    """Work out each track's effective gain and publish the whole set to the mixer at once.
+
+    A solo changes every gain in the same block, and audio_callback ramps to the
+    new gains across that block, so mutes and volume drags don't click.
+    """
+    for i, track in enumerate(tracks):
+        mix_gains[i] = 0.0 if mute_flags[i] else track['volume']
+    session_gains.publish(mix_gains)
+
+def sync_mixer():
+    """With --mixer-process: send this frame's transport changes to the mixer and read back its state.
+
+    Stands in for the part of audio_callback that talks to the UI. The position and
+    play state are only taken from the mixer once it has applied every seek and play
+    request, so the slider doesn't jump back while a seek is on its way.
+    """
+    global playing, playback_frame
+    if loop_event.is_set():
+        loop_event.clear()
+        streamer.set_loop(loop_region)
     if seek_event.is_set():
         seek_event.clear()
-        playback_position = seek_position
-
-    start_sample = int(playback_position * tracks[0]['samplerate'])
-    end_sample = start_sample + frames
-    data = np.zeros((frames, 2), dtype='float32')  # Initialize buffer for stereo output
+        streamer.seek(seek_frame)
+    if playing != streamer.play_request:
+        streamer.play(playing)
+    if streamer.settled():
+        playing, playback_frame = streamer.transport()
+    streamer.read_levels(meters, limiter)
 
-    for i, track in enumerate(tracks):
-        if not mute_flags[i]:
-            track_data = track['data']
-            track_samples = track_data[start_sample:end_sample]
-            # Apply volume control
-            track_samples = track_samples * track['volume']
-            if track_samples.shape[0] < frames:
-                # Pad with zeros if track is shorter
-                padding = np.zeros((frames - track_samples.shape[0], track_samples.shape[1]))
-                track_samples = np.vstack((track_samples, padding))
-            data += track_samples
-
-    # Normalize mixed data to prevent clipping
-    max_amp = np.max(np.abs(data))
-    if max_amp > 1.0:
-        data /= max_amp
-
-    outdata[:] = data
-
-    playback_position += frames / tracks[0]['samplerate']
-    if playback_position >= total_duration:
-        raise sd.CallbackStop
-
-def play_audio():
-    """Function to play audio using sounddevice."""
-    global tracks, playing
-    samplerate = tracks[0]['samplerate']
-    blocksize = 1024
-    with sd.OutputStream(channels=2,
-                        samplerate=samplerate,
-                        blocksize=blocksize,
-                        callback=audio_callback):
-
-        while not stop_event.is_set():
-            threading.Event().wait(0.1)
+def callback_telemetry():
+    """Telemetry of whichever callback is mixing: audio_callback, or the mixer process's copy."""
+    return streamer.telemetry if args.mixer_process and streamer is not None else telemetry
 
-    playing = False
+def audio_callback(outdata, frames, time, status):
+    """Callback of the output stream: mix the next block of the playing stems into outdata."""
+    global playback_frame, playing, skip_requested
+    started = perf_counter()
+    if status:
+        # Underflows are counted and played through rather than aborting the stream
+        telemetry.record_status(status)
+
+    if loop_event.is_set():
+        loop_event.clear()
+        streamer.set_loop(loop_region)
+    if seek_event.is_set():
+        seek_event.clear()
+        streamer.seek(seek_frame)
+        playback_frame = seek_frame
+    upcoming = queued_session  # Read once: the UI thread can take it back
+    if skip_requested:
+        skip_requested = False
+        if upcoming is not None:
+            switch_to_queued(upcoming)
+            upcoming = None
+            playback_frame = 0
+
+    block = streamer.read(frames) if playing else None
+    if block is None:
+        # Paused, refilling after a seek, or the disk fell behind: play silence
+        outdata.fill(0)
+        gain_ramp.settle()
+        # Still run the limiter so the end of its delay line plays out
+        limiter.process(outdata)
+        meters.clear()
+        telemetry.record_block(perf_counter() - started, frames, session_samplerate)
+        # Lets the null and file outputs idle while paused
+        return not playing and not outdata.any()
+    played = min(frames, streamer.buffered_frames())
+    gain_ramp.mix(block, outdata)
+    meters.measure(block, gain_ramp.current)
+    streamer.advance(frames)
+
+    playback_frame = streamer.play_frame
+    if playback_frame >= streamer.total_frames and upcoming is not None:
+        # Gapless: the next song starts in this block, right after the last frame of this one
+        switch_to_queued(upcoming)
+        rest = outdata[played:]
+        block = streamer.read(len(rest)) if len(rest) else None
+        if block is not None:
+            gain_ramp.mix(block, rest)
+            streamer.advance(len(rest))
+        playback_frame = streamer.play_frame
+    elif playback_frame >= streamer.total_frames:
+        # Pause at the end; the stream keeps running for the next play
+        playing = False
+    limiter.process(outdata)
+    telemetry.record_block(perf_counter() - started, frames, session_samplerate)
 
 # Main Code Execution
 if __name__ == "__main__":
-    # Load track type configurations from JSON file
+    parser = argparse.ArgumentParser(description="Play and mix a song's stems.")
+    parser.add_argument('stems', nargs='*', help="stem files, or a folder of stems, to open at startup")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print the time to the first frame and until the opened stems are playable")
+    parser.add_argument('--output', choices=OUTPUT_BACKENDS, default='sounddevice',
+                        help="where the mix goes: the sound card, nowhere (as fast as it can be mixed) "
+                             "or a file (default: %(default)s)")
+    parser.add_argument('--output-file', default='stem-player-output.wav', help="file for --output file (default: %(default)s)")
+    parser.add_argument('--realtime', action='store_true', help="pace the null and file outputs to the sample rate")
+    parser.add_argument('--mixer-process', action='store_true',
+                        help="mix and play in a separate process, so a busy window can't interrupt the audio")
+    parser.add_argument('--play', action='store_true', help="start playing the stems given on the command line")
+    parser.add_argument('--playlist', action='store_true',
+                        help="treat each stems argument as one song (a folder of stems) and play them in order")
+    parser.add_argument('--quit-at-end', action='store_true', help="quit once playback reaches the end of the last song")
+    args = parser.parse_args()
+    imports_done = perf_counter()
+
+    # Track type configurations are loaded from this JSON file when the first song opens
     script_dir = os.path.dirname(os.path.abspath(__file__))
     config_file = os.path.join(script_dir, "track_types.json")
-    with open(config_file, "r") as f:
-        config_data = json.load(f)
-
-    track_types = config_data["track_types"]  # Hierarchical dictionary
-
-    # Assign order indices to track types
-    assign_order_indices(track_types)
-
-    default_icon_filename = config_data.get("default_icon", "music-notes.png")
-    default_color = config_data.get("default_color", [150, 150, 150])
 
     # Adjust the icon_location to point to your icons directory relative to the script directory
     icon_location = os.path.join(script_dir, "icons")
@@ -527,6 +1484,27 @@ if __name__ == "__main__":
     # UI Elements
     MENU_BAR_HEIGHT = 40
     PLAY_BUTTON_SIZE = 50
+    TRACK_WAVEFORM_HEIGHT = 40
+    VISUALIZER_HEIGHT = 200
+    VISUALIZER_BARS = 50
+    # Spectrogram colours from the floor level to 0 dB: black, blue, magenta, orange, yellow, white
+    SPECTROGRAM_PALETTE = np.stack([np.interp(np.arange(256), [0, 60, 120, 180, 230, 255], channel)
+                                    for channel in ([0, 20, 160, 250, 255, 255], [0, 10, 20, 120, 230, 255],
+                                                    [0, 120, 150, 20, 40, 255])], axis=1).astype(np.uint8)
+    METER_FLOOR_DB = -60  # Bottom of the track level meters
+    METER_FALL_DB_PER_S = 24  # How fast a meter drops after the level falls
+    METER_PEAK_HOLD_S = 1.5  # How long the peak marker stays before it falls
+
+    BACKGROUND_COLOR = (50, 50, 50)
+    PLAYING_FPS = 60  # Redraw rate cap while anything on screen moves
+    IDLE_WAIT_MS = 250  # Longest wait for an event while nothing moves, so finished loads still show up
+    # Window areas redrawn on their own when only playback changes
+    PLAY_BUTTON_AREA = pygame.Rect((SCREEN_WIDTH - PLAY_BUTTON_SIZE) // 2, SCREEN_HEIGHT - 150, PLAY_BUTTON_SIZE, PLAY_BUTTON_SIZE)
+    SLIDER_AREA = pygame.Rect(0, SCREEN_HEIGHT - 106, SCREEN_WIDTH, 32)
+    TIMECODE_AREA = pygame.Rect(0, SCREEN_HEIGHT - 66, SCREEN_WIDTH, 32)
+    LIMITER_METER_AREA = pygame.Rect(PLAY_BUTTON_AREA.right + 30, PLAY_BUTTON_AREA.top, 100, 44)
+    LIMITER_METER_RANGE_DB = 12  # Gain reduction at which the limiter bar is full
+    LIMITER_METER_FALL_DB_PER_S = 12
 
     # Dictionary to hold UI element rectangles for interaction
     ui_elements = {}
@@ -550,83 +1528,123 @@ if __name__ == "__main__":
     initial_mouse_y = None
     click_detected = False
 
+    # Stems from the command line open right after the first frame is shown
+    if args.playlist:
+        startup_songs = [expand_stem_paths([path]) for path in args.stems]
+    else:
+        startup_songs = [expand_stem_paths(args.stems)] if args.stems else []
+    first_frame_time = None
+    playable_time = None
+    play_when_ready = args.play  # Start playing once every stem of the session is loaded
+
 running = True
+clock = pygame.time.Clock()
 
 while running:
-    for event in pygame.event.get():
+    if needs_animation():
+        clock.tick(PLAYING_FPS)
+        events = pygame.event.get()
+    else:
+        # Nothing moves on screen: sleep until there is input, or briefly to pick up finished background work
+        events = [event for event in [pygame.event.wait(IDLE_WAIT_MS)] + pygame.event.get() if event.type != NOEVENT]
+    for event in events:
         if event.type == QUIT:
-            stop_event.set()
-            if audio_thread and audio_thread.is_alive():
-                audio_thread.join()
             running = False
+        elif event.type == KEYDOWN and library_open:
+            # The library browser takes the keyboard while it is open
+            if event.key == K_ESCAPE:
+                library_open = False
+            elif event.key in (K_RETURN, K_KP_ENTER):
+                # Shift+Enter adds the song to the playlist instead of replacing it
+                open_library_selection(library_selection, queue=bool(event.mod & KMOD_SHIFT))
+            elif event.key == K_UP:
+                library_selection = max(0, library_selection - 1)
+            elif event.key == K_DOWN:
+                library_selection = min(len(library_results) - 1, library_selection + 1)
+            elif event.key == K_BACKSPACE:
+                search_library(library_query[:-1])
+            elif event.unicode and event.unicode.isprintable():
+                search_library(library_query + event.unicode)
+        elif event.type == MOUSEWHEEL and library_open:
+            library_selection = max(0, min(len(library_results) - 1, library_selection - event.y))
         elif event.type == KEYDOWN:
             if event.key == K_ESCAPE:
-                stop_event.set()
-                if audio_thread and audio_thread.is_alive():
-                    audio_thread.join()
                 running = False
             elif event.key == K_l:
-                stop_event.set()
-                if audio_thread and audio_thread.is_alive():
-                    audio_thread.join()
                 load_sound_files()
+            elif event.key == K_w:
+                warm_cache_dialog()
+            elif event.key == K_o:
+                open_library()
+            elif event.key == K_n:
+                skip_to_next()
+            elif event.key == K_t:
+                show_telemetry = not show_telemetry
+            elif event.key == K_m:
+                show_memory = not show_memory
+            elif event.key == K_v:
+                visualizer_mode = {None: 'spectrogram', 'spectrogram': 'spectrum', 'spectrum': None}[visualizer_mode]
+            elif event.key == K_s:
+                select_visualizer_track(pygame.mouse.get_pos())
             elif event.key == K_SPACE:
-                if not playing and total_duration > 0:
-                    # Play all tracks
-                    stop_event.clear()
-                    audio_thread = threading.Thread(target=play_audio)
-                    audio_thread.start()
-                    playing = True
-                else:
-                    # Stop all tracks
-                    stop_event.set()
-                    if audio_thread and audio_thread.is_alive():
-                        audio_thread.join()
-                    playing = False
+                toggle_playback()
+            elif event.key == K_a:
+                set_loop_point('a', playback_frame)
+            elif event.key == K_b:
+                set_loop_point('b', playback_frame)
+            elif event.key == K_c:
+                clear_loop()
+            elif event.key == K_MINUS:
+                change_speed(-0.05)
+            elif event.key == K_EQUALS:
+                change_speed(0.05)
             elif event.key == K_q:
                 # Prompt user to confirm exit
-                root = Tk()
-                root.withdraw()  # Hide the root window
-                result = messagebox.askyesno("Exit", "Are you sure you want to exit?")
-                root.destroy()
-                if result:
-                    stop_event.set()
-                    if audio_thread and audio_thread.is_alive():
-                        audio_thread.join()
+                if ask_yes_no("Exit", "Are you sure you want to exit?"):
                     running = False
         elif event.type == MOUSEBUTTONDOWN:
             pos = pygame.mouse.get_pos()
             if event.button == 1:  # Left mouse button
                 if ui_elements.get('load_button_rect') and ui_elements['load_button_rect'].collidepoint(pos):
                     # Load tracks
-                    stop_event.set()
-                    if audio_thread and audio_thread.is_alive():
-                        audio_thread.join()
                     load_sound_files()
                 elif ui_elements.get('settings_button_rect') and ui_elements['settings_button_rect'].collidepoint(pos):
                     # Toggle settings menu
                     settings_menu_open = not settings_menu_open
+                elif ui_elements.get('library_button_rect') and ui_elements['library_button_rect'].collidepoint(pos):
+                    # Toggle library browser
+                    if library_open:
+                        library_open = False
+                    else:
+                        open_library()
+                elif library_open:
+                    # Handle clicks inside the library browser
+                    if ui_elements.get('library_add_rect') and ui_elements['library_add_rect'].collidepoint(pos):
+                        scan_library_dialog()
+                    elif ui_elements.get('library_rescan_rect') and ui_elements['library_rescan_rect'].collidepoint(pos):
+                        start_library_scan()
+                    elif 'library_rect' not in ui_elements or not ui_elements['library_rect'].collidepoint(pos):
+                        library_open = False
+                    else:
+                        for index, row_rect in ui_elements.get('library_rows', []):
+                            if row_rect.collidepoint(pos):
+                                open_library_selection(index)
+                                break
                 elif ui_elements.get('play_button_rect') and ui_elements['play_button_rect'].collidepoint(pos):
                     # Play/Pause toggle
-                    if not playing and total_duration > 0:
-                        # Play all tracks
-                        stop_event.clear()
-                        audio_thread = threading.Thread(target=play_audio)
-                        audio_thread.start()
-                        playing = True
-                    else:
-                        # Stop all tracks
-                        stop_event.set()
-                        if audio_thread and audio_thread.is_alive():
-                            audio_thread.join()
-                        playing = False
+                    toggle_playback()
                 elif ui_elements.get('slider_rect') and ui_elements['slider_rect'].collidepoint(pos):
                     # Calculate new playback position
                     x = pos[0] - ui_elements['slider_rect'].x
                     ratio = x / ui_elements['slider_rect'].width
-                    seek_position = total_duration * ratio
-                    seek_event.set()
-                    playback_position = seek_position
+                    mods = pygame.key.get_mods()
+                    if mods & KMOD_SHIFT:
+                        # Shift-click sets the loop start, Ctrl-click the loop end
+                        set_loop_point('a', round(total_frames * ratio))
+                    elif mods & KMOD_CTRL:
+                        set_loop_point('b', round(total_frames * ratio))
+                    else:
+                        seek_to(round(total_frames * ratio))
                 elif settings_menu_open:
                     # Handle clicks inside the settings menu
                     if ui_elements.get('title_checkbox_rect') and ui_elements['title_checkbox_rect'].collidepoint(pos):
@@ -635,6 +1653,10 @@ while running:
                         show_full_labels = not show_full_labels
                     elif ui_elements.get('label_case_checkbox_rect') and ui_elements['label_case_checkbox_rect'].collidepoint(pos):
                         use_title_case_labels = not use_title_case_labels
+                    elif ui_elements.get('device_rate_checkbox_rect') and ui_elements['device_rate_checkbox_rect'].collidepoint(pos):
+                        match_device_samplerate = not match_device_samplerate
+                    elif ui_elements.get('compact_cache_checkbox_rect') and ui_elements['compact_cache_checkbox_rect'].collidepoint(pos):
+                        compact_cache = not compact_cache
                 else:
                     # Only interact with tracks if not in solo mode
                     if not rmb_pressed:
@@ -719,17 +1741,56 @@ while running:
                     mute_flags = prev_mute_flags.copy()
                     soloed_track_idx = None
 
-    screen.fill((50, 50, 50))
-    draw_menu_bar()
-    if show_title:
-        draw_artist_track_name()
-    draw_tracks()
-    draw_play_pause_button()
-    draw_playback_slider()
-    draw_timecode()
-    if settings_menu_open:
-        draw_settings_menu()
-    pygame.display.flip()
-
+    # Publish this frame's volume and mute changes to the mixer
+    update_mix_gains()
+    if args.mixer_process and streamer is not None:
+        sync_mixer()
+    update_playlist()
+
+    draw_started = perf_counter()
+    update_limiter_meter(draw_started)
+    # Track boxes can reach down over the transport when there are many of them
+    overlapping = any(track['rect'].bottom > PLAY_BUTTON_AREA.top for track in tracks if 'rect' in track)
+    if events or screen_dirty or overlays_open() or overlapping:
+        draw_frame()
+        pygame.display.flip()
+        screen_dirty = False
+    else:
+        changed = draw_playback_changes()
+        if changed:
+            pygame.display.update(changed)
+    record_frame(perf_counter() - draw_started)
+
+    if first_frame_time is None:
+        first_frame_time = perf_counter()
+        if startup_songs:
+            start_playlist(startup_songs)
+        if args.profile_startup:
+            print(f"Startup: imports {imports_done - startup_started:.3f} s, "
+                  f"first frame {first_frame_time - startup_started:.3f} s")
+    if (args.profile_startup and playable_time is None and streamer is not None and streamer.is_ready()
+            and all(track['ready'] or track.get('failed') for track in tracks)):
+        playable_time = perf_counter()
+        print(f"Startup: playable {playable_time - startup_started:.3f} s "
+              f"({len(tracks)} stems, {playable_time - first_frame_time:.3f} s after the first frame)")
+    if (play_when_ready and streamer is not None and streamer.is_ready()
+            and all(track['ready'] or track.get('failed') for track in tracks)):
+        # Every stem is loaded; seeking refills the ring from the start, where stems that
+        # joined late were buffered as silence, so a null or file output renders the same mix as an export
+        play_when_ready = False
+        seek_to(0)
+        toggle_playback()
+    if (args.quit_at_end and total_frames and playback_frame >= total_frames and not playing
+            and playlist_index + 1 >= len(playlist)):
+        running = False
+
+close_session()
+if spectrogram is not None:
+    spectrogram.close()
+if library_db is not None:
+    library_db.close()
+if tk_root is not None:
+    tk_root.destroy()
+telemetry.dump()
 pygame.quit()
 sys.exit()
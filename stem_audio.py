@@ -0,0 +1,1388 @@
+import os
+import threading
+import time
+import json
+import hashlib
+import collections
+import math
+from math import gcd
+from concurrent.futures import ThreadPoolExecutor
+import soundfile as sf
+import numpy as np
+
+# Audio side of the stem player: stem readers, the streaming ring buffer, resampling,
+# the decoded-audio cache, waveform peaks and the mixer. Nothing here depends on
+# pygame or tkinter, so the command-line tools can use it on machines without a
+# display or sound card.
+
+# Streaming
+MIX_BLOCK_FRAMES = 1024  # Frames mixed per audio_callback block
+STREAM_CHUNK_FRAMES = 4096  # Frames decoded per stem on each read of the streaming thread
+STREAM_RING_CHUNKS = 16  # Ring buffer depth in chunks (about 1.5 seconds at 44.1 kHz)
+STREAM_START_CHUNKS = 2  # Chunks that must be buffered before playback starts
+LOOP_CROSSFADE_FRAMES = 256  # Frames blended across an A/B loop's wrap point
+
+# Time-stretch
+STRETCH_FRAME_FRAMES = 1024  # WSOLA segment length; segments overlap by half
+STRETCH_TOLERANCE_FRAMES = 256  # How far a segment may move from its nominal position to line up
+STRETCH_MIN_SPEED = 0.5  # Slowest playback speed
+
+# Resampling
+RESAMPLE_CUTOFF = 0.45  # Filter cutoff as a fraction of the lower rate; the transition band ends at its Nyquist
+RESAMPLE_STOPBAND_DB = 90  # Attenuation from the lower rate's Nyquist up, so nothing aliases audibly
+RESAMPLE_KAISER_BETA = 0.1102 * (RESAMPLE_STOPBAND_DB - 8.7)  # Kaiser's window shape for that attenuation
+# Filter half-length in samples of the lower rate, from Kaiser's estimate for a transition band of 2 * (0.5 - cutoff)
+RESAMPLE_HALF_WIDTH = math.ceil((RESAMPLE_STOPBAND_DB - 7.95) / (14.36 * 2 * (0.5 - RESAMPLE_CUTOFF)) / 2)
+RESAMPLE_CHUNK_FRAMES = 16384  # Output frames computed per vectorized step
+RESAMPLE_FILTER_VERSION = 2  # Part of every cache key, so stems resampled with an older filter are redone
+
+# Decoded-audio cache
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "stem-player")
+CACHE_MAX_BYTES = 8 * 1024 ** 3  # Least recently used files are evicted beyond this size
+CACHE_CHUNK_FRAMES = 262144  # Frames decoded per step when filling the cache
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac')
+INT16_SCALE = 1 / 32768  # Converts samples of 16-bit cache files to float
+
+# Waveform peaks
+PEAK_BIN_FRAMES = 256  # Frames per min/max pair at the finest level of the waveform pyramid
+
+# Spectrogram
+SPECTRUM_FFT_FRAMES = 2048  # Hann window length of each spectrogram column
+SPECTRUM_HOP_FRAMES = 512  # Song frames between columns
+SPECTRUM_MIN_HZ = 30  # Lowest frequency shown; rows are spaced logarithmically above it
+SPECTRUM_FLOOR_DB = -90  # Level shown as black
+SPECTRUM_BATCH_COLUMNS = 64  # Columns transformed per batched rfft
+
+# Master limiter
+LIMITER_CEILING = 1.0  # Highest sample value the limiter lets through
+LIMITER_LOOKAHEAD_FRAMES = 128  # Delay that lets the gain ramp down before a peak arrives
+LIMITER_RELEASE_S = 0.15  # Time for the gain to recover from silence to full; recovery is linear
+
+# Output backends
+OUTPUT_BACKENDS = ('sounddevice', 'null', 'file')
+OUTPUT_IDLE_POLL_S = 0.02  # How often a paused null or file output asks the callback whether playback resumed
+
+# Callback telemetry
+TELEMETRY_BINS = 20  # Histogram buckets across one block period; one more bucket counts missed deadlines
+TELEMETRY_RECENT_BLOCKS = 256  # Per-block load history kept for the overlay
+TELEMETRY_LOG = os.path.join(CACHE_DIR, "telemetry.log")
+
+# libsndfile and NumPy release the GIL while decoding and filtering, so threads run stems in parallel
+DECODE_WORKERS = os.cpu_count() or 4
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+
+class FileStemReader:
+    """Reads a stem by decoding it with soundfile.SoundFile as it streams."""
+
+    def __init__(self, path, chunk_frames=STREAM_CHUNK_FRAMES):
+        self.file = sf.SoundFile(path)
+        self.frames = self.file.frames
+        self.channels = self.file.channels
+        self.buffer = np.zeros((chunk_frames, self.channels), dtype='float32')
+
+    def seek(self, frame):
+        self.file.seek(min(frame, self.frames))
+
+    def read(self, count):
+        """Return up to count frames as (frames, channels); fewer at the end of the file."""
+        return self.file.read(count, out=self.buffer[:count])
+
+    def close(self):
+        self.file.close()
+
+class ArrayStemReader:
+    """Reads a stem that is already decoded, such as a memory-mapped cache file."""
+
+    def __init__(self, data):
+        self.data = data
+        self.frames = len(data)
+        self.channels = data.shape[1]
+        self.position = 0
+
+    def seek(self, frame):
+        self.position = min(frame, self.frames)
+
+    def read(self, count):
+        """Return up to count frames as a view into the data."""
+        block = self.data[self.position:self.position + count]
+        self.position += len(block)
+        return block
+
+    def close(self):
+        self.data = None
+
+def read_stems(readers, block):
+    """Read the next block.shape[1] frames of every stem into block (n_tracks, frames, 2).
+
+    Stems without a reader, or that end early, are zero-padded.
+    """
+    count = block.shape[1]
+    for i, reader in enumerate(readers):
+        if reader is None:
+            block[i] = 0
+            continue
+        data = reader.read(count)
+        n = len(data)
+        # Mono blocks broadcast across both channels; extra channels are dropped
+        block[i, :n] = data[:, :2]
+        if data.dtype == np.int16:
+            block[i, :n] *= INT16_SCALE
+        block[i, n:] = 0
+
+def float_samples(data):
+    """Return cached stem samples as float32, scaling 16-bit cache data to full scale 1.0."""
+    if data.dtype == np.int16:
+        return data * np.float32(INT16_SCALE)
+    return data
+
+class TimeStretcher:
+    """Streaming WSOLA time-stretch applied to every stem at once.
+
+    Input is pushed in playback order along with the song frame of every input
+    frame. Each step takes a Hann-windowed segment near the nominal analysis
+    position, picking the offset whose sum over all stems best continues the
+    previous segment, and overlap-adds it one synthesis hop later. Every stem uses
+    the same offset, so the stems stay sample-aligned with each other.
+    """
+
+    def __init__(self, n_tracks, read_frames):
+        self.frame = STRETCH_FRAME_FRAMES
+        self.hop = STRETCH_FRAME_FRAMES // 2
+        self.tolerance = STRETCH_TOLERANCE_FRAMES
+        window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(self.frame) / self.frame)
+        self.window = window.astype('float32')[None, :, None]
+        # The first segment after a reset starts at full level instead of fading in
+        self.first_window = self.window.copy()
+        self.first_window[:, :self.hop] = 1
+        self.capacity = read_frames + self.frame + 2 * self.tolerance + self.hop
+        self.input = np.zeros((n_tracks, self.capacity, 2), dtype='float32')
+        self.input_positions = np.zeros(self.capacity, dtype=np.int64)
+        self.mix = np.zeros(self.capacity, dtype='float32')  # Sum of every stem and channel, for lining up segments
+        self.accum = np.zeros((n_tracks, self.frame, 2), dtype='float32')
+        self.scratch = np.zeros_like(self.accum)
+        self.out = np.zeros((n_tracks, self.hop, 2), dtype='float32')
+        self.out_positions = np.zeros(self.hop, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        """Forget all input, for a seek or a change of loop or speed."""
+        self.count = 0  # Input frames held
+        self.analysis = 0.0  # Nominal input index of the next segment
+        self.previous = None  # Input index of the last segment used
+        self.accum[:] = 0
+
+    def frames_needed(self):
+        """Input frames still missing before step() can run."""
+        end = int(round(self.analysis)) + self.tolerance + self.frame
+        if self.previous is not None:
+            end = max(end, self.previous + self.hop + self.frame)
+        return end - self.count
+
+    def input_space(self, frames):
+        """Return (block, positions) views where up to frames of new input can be written."""
+        if self.count + frames > self.capacity:
+            # Drop input no future segment or template can reach
+            keep = int(round(self.analysis)) - self.tolerance
+            if self.previous is not None:
+                keep = min(keep, self.previous + self.hop)
+            keep = max(0, keep)
+            held = self.count - keep
+            self.input[:, :held] = self.input[:, keep:self.count]
+            self.input_positions[:held] = self.input_positions[keep:self.count]
+            self.mix[:held] = self.mix[keep:self.count]
+            self.count = held
+            self.analysis -= keep
+            if self.previous is not None:
+                self.previous -= keep
+        frames = min(frames, self.capacity - self.count)
+        return self.input[:, self.count:self.count + frames], self.input_positions[self.count:self.count + frames]
+
+    def pushed(self, frames):
+        """Mark frames written into the last input_space() as input."""
+        block = self.input[:, self.count:self.count + frames]
+        self.mix[self.count:self.count + frames] = block.sum(axis=0).sum(axis=1)
+        self.count += frames
+
+    def pad_end(self, position, frames):
+        """Push silence past the end of the song so the last segments can be finished."""
+        block, positions = self.input_space(frames)
+        block[:] = 0
+        positions[:] = position
+        self.pushed(len(positions))
+
+    def step(self, speed):
+        """Overlap-add one segment and return the finished hop as (block, positions).
+
+        The returned arrays are reused by the next step.
+        """
+        target = int(round(self.analysis))
+        if self.previous is None:
+            start = target
+            window = self.first_window
+        else:
+            # Find the segment that best continues the previous one, on the mix of all stems
+            natural = self.previous + self.hop
+            template = self.mix[natural:natural + self.frame]
+            low = max(0, target - self.tolerance)
+            region = self.mix[low:target + self.tolerance + self.frame]
+            candidates = np.lib.stride_tricks.sliding_window_view(region, self.frame)
+            start = low + int(np.argmax(candidates @ template))
+            window = self.window
+        np.multiply(self.input[:, start:start + self.frame], window, out=self.scratch)
+        self.accum += self.scratch
+        self.out[:] = self.accum[:, :self.hop]
+        # The hop is credited to the nominal input positions, so the transport stays exact
+        indices = (self.analysis + np.arange(self.hop) * speed).astype(np.int64)
+        np.minimum(indices, self.count - 1, out=indices)
+        self.out_positions[:] = self.input_positions[indices]
+        self.accum[:, :self.hop] = self.accum[:, self.hop:]
+        self.accum[:, self.hop:] = 0
+        self.previous = start
+        self.analysis += self.hop * speed
+        return self.out, self.out_positions
+
+class StemStreamer:
+    """Streams stems from disk into a bounded ring buffer ahead of the playhead.
+
+    A background thread reads blocks from every stem's reader and writes them as
+    stereo float32 into a ring buffer shaped (n_tracks, ring_frames, 2).
+    audio_callback only copies out of the ring, so memory use stays flat no matter
+    how long the tracks are. A stem without a reader yet (still being resampled)
+    streams silence until attach() hands one over.
+
+    The ring holds frames in playback order: with an A/B loop set, the streaming
+    thread writes the loop start right after the loop end, crossfaded, so the wrap
+    lands mid-block with no gap. Below full speed the streaming thread also
+    time-stretches what it reads before writing it. read_frame and write_frame
+    count frames through the ring, and positions records which song frame each
+    ring frame came from.
+    """
+
+    def __init__(self, readers, total_frames, chunk_frames=STREAM_CHUNK_FRAMES, ring_chunks=STREAM_RING_CHUNKS):
+        self.readers = list(readers)
+        self.pending_readers = {}  # Track index -> reader waiting to be installed by the streaming thread
+        self.pending_lock = threading.Lock()  # Guards pending_readers between attach() and the streaming thread
+        self.total_frames = total_frames
+        self.chunk_frames = chunk_frames
+        self.ring_frames = chunk_frames * ring_chunks
+        self.ring = np.zeros((len(self.readers), self.ring_frames, 2), dtype='float32')
+        # Block used when a read wraps around the end of the ring
+        self.wrap_block = np.zeros((len(self.readers), chunk_frames, 2), dtype='float32')
+        self.positions = np.zeros(self.ring_frames, dtype=np.int64)  # Song frame of every ring frame
+        self.fade_block = np.zeros((len(self.readers), LOOP_CROSSFADE_FRAMES, 2), dtype='float32')
+        self.splice_block = np.zeros((len(self.readers), LOOP_CROSSFADE_FRAMES, 2), dtype='float32')
+        self.splice_left = 0  # Frames still to crossfade with the audio a truncation dropped
+        self.stretcher = TimeStretcher(len(self.readers), chunk_frames)
+        self.read_frame = 0  # Next ring frame audio_callback will consume
+        self.write_frame = 0  # Next ring frame the streaming thread will fill
+        self.source_frame = 0  # Next song frame the streaming thread will read
+        self.play_frame = 0  # Song frame at the playhead
+        self.exhausted = False  # Set once everything up to the end of the song is in the ring
+        self.loop = None  # (start, end) song frames the streaming thread is looping
+        self.speed = 1.0  # Playback speed the streaming thread is stretching to
+        self.seek_target = 0
+        self.seek_serial = 0  # Bumped by seek(); compared with applied_serial by the streaming thread
+        self.applied_serial = 0
+        self.loop_target = None
+        self.loop_serial = 0  # Bumped by set_loop(); compared with applied_loop_serial
+        self.applied_loop_serial = 0
+        self.speed_target = 1.0
+        self.speed_serial = 0  # Bumped by set_speed(); compared with applied_speed_serial
+        self.applied_speed_serial = 0
+        self.lock = threading.Lock()  # Held by audio_callback while it uses the ring
+        self.wake = threading.Event()  # Set when the streaming thread has work to do
+        self.closing = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """Streaming thread: keep the ring topped up and handle seeks, loops and speed changes."""
+        while not self.closing:
+            self.wake.clear()
+            if self.pending_readers:
+                self._install_readers()
+            if self.loop_serial != self.applied_loop_serial:
+                self._apply_loop()
+            if self.speed_serial != self.applied_speed_serial:
+                self._apply_speed()
+            if self.seek_pending():
+                self._apply_seek()
+            elif (not self.exhausted
+                  and self.write_frame - self.read_frame + self.chunk_frames <= self.ring_frames):
+                self._fill_chunk()
+            else:
+                self.wake.wait(0.05)
+
+    def _apply_seek(self):
+        """Drop everything buffered and restart reading at the requested frame."""
+        with self.lock:
+            serial = self.seek_serial
+            frame = self.seek_target
+            self.applied_serial = serial
+            self.read_frame = self.write_frame
+            self.source_frame = frame
+            self.play_frame = frame
+            self.exhausted = False
+            self.splice_left = 0
+        self.stretcher.reset()
+        self._seek_readers(frame)
+
+    def _apply_loop(self):
+        """Switch to the requested loop."""
+        with self.lock:
+            old_loop = self.loop
+            self.applied_loop_serial = self.loop_serial
+            self.loop = self.loop_target
+            frame = self._truncate(old_loop, self.speed)
+        self._resume(frame)
+
+    def _apply_speed(self):
+        """Switch to the requested playback speed."""
+        with self.lock:
+            old_speed = self.speed
+            self.applied_speed_serial = self.speed_serial
+            self.speed = self.speed_target
+            frame = self._truncate(self.loop, old_speed)
+        self._resume(frame)
+
+    def _truncate(self, old_loop, old_speed):
+        """Drop what is buffered past the next chunk, so it is re-read under the new loop or speed.
+
+        The chunk after the playhead is kept so audio_callback never runs dry; the
+        rest was written under the old settings. Called by the streaming thread with
+        the lock held, so it only moves the ring indices: returns the song frame to
+        re-read from, or None if nothing was dropped, for _resume() to seek to
+        after the lock is released.
+        """
+        if self.seek_pending():
+            return None  # The seek drops the whole buffer anyway
+        buffered = self.write_frame - self.read_frame
+        keep = min(buffered, self.chunk_frames)
+        if keep == buffered and old_speed == 1.0 and self.speed == 1.0:
+            return None  # Nothing to drop; the stream continues from source_frame
+        self.write_frame = self.read_frame + keep
+        if keep:
+            frame = int(self.positions[(self.write_frame - 1) % self.ring_frames]) + 1
+            if old_loop is not None and frame == old_loop[1]:
+                frame = old_loop[0]
+        elif old_speed != 1.0:
+            frame = self.play_frame  # source_frame ran ahead of the output while stretching
+        else:
+            frame = self.source_frame
+        # Set here, the dropped audio is copied out by _resume()
+        self.splice_left = LOOP_CROSSFADE_FRAMES if buffered - keep >= LOOP_CROSSFADE_FRAMES else 0
+        self.source_frame = frame
+        self.exhausted = False
+        return frame
+
+    def _resume(self, frame):
+        """Seek the readers to where _truncate() left off, without holding the lock.
+
+        audio_callback never reads past write_frame, so the dropped audio after it
+        can still be saved for the crossfade into what replaces it.
+        """
+        if frame is None:
+            return
+        if self.splice_left:
+            indices = np.arange(self.write_frame, self.write_frame + LOOP_CROSSFADE_FRAMES) % self.ring_frames
+            self.splice_block[:] = self.ring[:, indices]
+        self.stretcher.reset()
+        self._seek_readers(frame)
+
+    def _seek_readers(self, frame):
+        for reader in self.readers:
+            if reader is not None:
+                reader.seek(frame)
+
+    def _install_readers(self):
+        """Swap in readers handed over by attach(), joining the stream at the read position."""
+        with self.pending_lock:
+            pending, self.pending_readers = self.pending_readers, {}
+        for index, reader in pending.items():
+            reader.seek(self.source_frame)
+            replaced = self.readers[index]
+            self.readers[index] = reader
+            if replaced is not None:
+                replaced.close()
+
+    def _read_source(self, block, positions):
+        """Read the next frames in playback order into block, zero-padding stems that have ended.
+
+        Returns the number of frames read, at most block.shape[1]. A read never
+        crosses the loop end: the frames just before it are blended with the frames
+        just before the loop start, and reading continues there.
+        """
+        start = self.source_frame
+        loop = self.loop
+        looping = loop is not None and start < loop[1]
+        end = loop[1] if looping else self.total_frames
+        count = min(block.shape[1], end - start)
+        block = block[:, :count]
+        read_stems(self.readers, block)
+        positions[:count] = np.arange(start, start + count)
+        next_frame = start + count
+        if looping:
+            loop_start, loop_end = loop
+            fade = min(LOOP_CROSSFADE_FRAMES, loop_start, loop_end - loop_start)
+            fade_from = max(start, loop_end - fade)
+            if fade and next_frame > fade_from:
+                # Crossfade the loop end into the audio leading up to the loop start
+                n = next_frame - fade_from
+                self._seek_readers(fade_from - (loop_end - loop_start))
+                read_stems(self.readers, self.fade_block[:, :n])
+                weights = ((np.arange(fade_from, next_frame) - (loop_end - fade) + 0.5) / fade).astype('float32')
+                weights = weights[None, :, None]
+                tail = block[:, count - n:]
+                tail *= 1 - weights
+                tail += self.fade_block[:, :n] * weights
+                if next_frame < loop_end:
+                    self._seek_readers(next_frame)
+            if next_frame == loop_end:
+                next_frame = loop_start
+                self._seek_readers(next_frame)
+        self.source_frame = next_frame
+        return count
+
+    def _fill_chunk(self):
+        """Write the next chunk of playback into the ring."""
+        if self.speed != 1.0:
+            self._fill_stretched()
+            return
+        index = self.write_frame % self.ring_frames
+        end = min(index + self.chunk_frames, self.ring_frames)
+        count = self._read_source(self.ring[:, index:end], self.positions[index:end])
+        self._commit(index, count)
+        if self.source_frame >= self.total_frames:
+            self.exhausted = True
+
+    def _fill_stretched(self):
+        """Time-stretch up to a chunk of playback into the ring, one synthesis hop at a time."""
+        stretcher = self.stretcher
+        produced = 0
+        while produced + stretcher.hop <= self.chunk_frames:
+            needed = stretcher.frames_needed()
+            if needed > 0:
+                if self.source_frame < self.total_frames:
+                    block, positions = stretcher.input_space(self.chunk_frames)
+                    stretcher.pushed(self._read_source(block, positions))
+                else:
+                    stretcher.pad_end(self.total_frames, needed)
+                continue
+            block, positions = stretcher.step(self.speed)
+            if positions[0] >= self.total_frames:
+                self.exhausted = True
+                return
+            # Copy the hop into the ring, which it may straddle the end of
+            written = 0
+            while written < stretcher.hop:
+                index = self.write_frame % self.ring_frames
+                count = min(stretcher.hop - written, self.ring_frames - index)
+                self.ring[:, index:index + count] = block[:, written:written + count]
+                self.positions[index:index + count] = positions[written:written + count]
+                self._commit(index, count)
+                written += count
+            produced += stretcher.hop
+
+    def _commit(self, index, count):
+        """Publish count frames written at ring index to audio_callback."""
+        if self.splice_left:
+            # Crossfade from the audio _truncate() dropped into the audio that replaces it
+            done = LOOP_CROSSFADE_FRAMES - self.splice_left
+            n = min(count, self.splice_left)
+            weights = ((np.arange(done, done + n) + 0.5) / LOOP_CROSSFADE_FRAMES).astype('float32')[None, :, None]
+            head = self.ring[:, index:index + n]
+            head *= weights
+            head += self.splice_block[:, done:done + n] * (1 - weights)
+            self.splice_left -= n
+        self.write_frame += count
+
+    def seek_pending(self):
+        """True while a seek has been requested but not yet applied."""
+        return self.seek_serial != self.applied_serial
+
+    def buffered_frames(self):
+        """Number of frames ready to be played."""
+        return self.write_frame - self.read_frame
+
+    def is_ready(self):
+        """True once the first few chunks after the playhead are buffered."""
+        buffered = self.buffered_frames() >= self.chunk_frames * STREAM_START_CHUNKS
+        return not self.seek_pending() and (buffered or self.exhausted)
+
+    def seek(self, frame):
+        """Ask the streaming thread to refill the ring starting at frame."""
+        self.seek_target = max(0, min(int(frame), self.total_frames))
+        self.seek_serial += 1
+        self.wake.set()
+
+    def set_loop(self, region):
+        """Ask the streaming thread to loop between (start, end) song frames, or stop looping with None.
+
+        Playback already past the loop end plays on; the loop applies the next time
+        the stream reads into it.
+        """
+        if region is not None:
+            start, end = (max(0, min(int(frame), self.total_frames)) for frame in region)
+            region = (start, end) if end > start else None
+        self.loop_target = region
+        self.loop_serial += 1
+        self.wake.set()
+
+    def set_speed(self, speed):
+        """Ask the streaming thread to play at speed (STRETCH_MIN_SPEED to 1.0) without changing pitch."""
+        self.speed_target = max(STRETCH_MIN_SPEED, min(1.0, float(speed)))
+        self.speed_serial += 1
+        self.wake.set()
+
+    def read(self, frames):
+        """Return the next frames of every stem as (n_tracks, frames, 2), or None if not buffered.
+
+        Called from audio_callback and never blocks. On success the ring stays locked
+        until advance() is called, so a seek can't overwrite the block while it is mixed.
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        available = self.write_frame - self.read_frame
+        if self.seek_pending() or (available < frames and not self.exhausted):
+            self.lock.release()
+            return None
+        count = min(frames, available)
+        index = self.read_frame % self.ring_frames
+        if index + frames <= self.ring_frames and count == frames:
+            return self.ring[:, index:index + frames]
+        # The block wraps around the end of the ring or runs past the end of the tracks
+        block = self.wrap_block[:, :frames]
+        block[:] = 0
+        first = min(count, self.ring_frames - index)
+        block[:, :first] = self.ring[:, index:index + first]
+        block[:, first:count] = self.ring[:, :count - first]
+        return block
+
+    def advance(self, frames):
+        """Release the block returned by read() and move the playhead forward."""
+        self.read_frame = min(self.read_frame + frames, self.write_frame)
+        if self.read_frame < self.write_frame:
+            self.play_frame = int(self.positions[self.read_frame % self.ring_frames])
+        elif self.exhausted:
+            self.play_frame = self.total_frames
+        else:
+            self.play_frame = min(int(self.positions[(self.read_frame - 1) % self.ring_frames]) + 1, self.total_frames)
+        self.lock.release()
+        self.wake.set()
+
+    def buffer_bytes(self):
+        """Bytes of ring, crossfade and time-stretch buffers held for each track."""
+        stretcher = self.stretcher
+        arrays = [self.ring, self.wrap_block, self.fade_block, self.splice_block,
+                  stretcher.input, stretcher.accum, stretcher.scratch, stretcher.out]
+        return sum(array.nbytes for array in arrays) // max(1, len(self.readers))
+
+    def attach(self, index, reader):
+        """Hand a stem's reader to the streaming thread, replacing any reader it already has.
+
+        Once the streamer is closing the reader is closed instead, since close() may
+        already have run through the readers it owns.
+        """
+        with self.pending_lock:
+            if self.closing:
+                replaced = reader
+            else:
+                replaced = self.pending_readers.pop(index, None)
+                self.pending_readers[index] = reader
+        if replaced is not None:
+            replaced.close()
+        self.wake.set()
+
+    def close(self):
+        """Stop the streaming thread and close every reader."""
+        with self.pending_lock:
+            self.closing = True
+            pending, self.pending_readers = self.pending_readers, {}
+        self.wake.set()
+        self.thread.join()
+        for reader in self.readers + list(pending.values()):
+            if reader is not None:
+                reader.close()
+
+def design_resample_filter(up, down):
+    """Design a Kaiser-windowed sinc low-pass for up/down resampling.
+
+    Returns the filter split into its polyphase branches as an (up, taps) array,
+    plus the index of the filter's center tap.
+    """
+    ratio = max(up, down)
+    center = RESAMPLE_HALF_WIDTH * ratio
+    n = np.arange(-center, center + 1)
+    cutoff = RESAMPLE_CUTOFF / ratio  # In cycles per upsampled sample
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(len(n), RESAMPLE_KAISER_BETA) * up
+    taps = -(-len(h) // up)
+    h = np.concatenate([h, np.zeros(taps * up - len(h))])
+    # polyphase[p, k] = h[p + k * up]
+    return h.reshape(taps, up).T.astype('float32'), center
+
+class LoadCancelled(Exception):
+    """Raised from a progress callback to abandon a stem whose session was replaced."""
+
+def resample_stem(path, samplerate, out_path, progress=None, dtype='float32'):
+    """Resample a whole stem to samplerate with a polyphase filter, writing it to an .npy file.
+
+    Works through the file in chunks of output frames; each chunk gathers every output
+    frame's input window at once and applies its filter phase in a single einsum.
+    progress, if given, is called with the fraction done after every chunk. With
+    dtype 'int16' the result is rounded to 16 bits.
+    """
+    with sf.SoundFile(path) as f:
+        divisor = gcd(f.samplerate, samplerate)
+        up = samplerate // divisor
+        down = f.samplerate // divisor
+        polyphase, center = design_resample_filter(up, down)
+        taps = polyphase.shape[1]
+        out_frames = -(-f.frames * up // down)
+        out = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=(out_frames, f.channels))
+        for start in range(0, out_frames, RESAMPLE_CHUNK_FRAMES):
+            m = np.arange(start, min(start + RESAMPLE_CHUNK_FRAMES, out_frames))
+            position = m * down + center
+            newest = position // up  # Latest input frame that reaches each output frame
+            phase = position % up
+            # Read the input span this chunk needs, with zeros beyond either end of the file
+            lo = newest[0] - taps + 1
+            hi = newest[-1] + 1
+            segment = np.zeros((hi - lo, f.channels), dtype='float32')
+            first, last = max(lo, 0), min(hi, f.frames)
+            if last > first:
+                f.seek(first)
+                f.read(last - first, out=segment[first - lo:last - lo])
+            windows = segment[newest[:, None] - np.arange(taps) - lo]
+            resampled = np.einsum('mk,mkc->mc', polyphase[phase], windows)
+            if out.dtype == np.int16:
+                resampled = np.clip(np.rint(resampled * 32768), -32768, 32767)
+            out[start:start + len(m)] = resampled
+            if progress:
+                progress((start + len(m)) / out_frames)
+        out.flush()
+        del out
+
+def decode_stem(path, out_path, progress=None, dtype='float32'):
+    """Decode a whole stem at its own rate into an .npy file of dtype samples, a chunk at a time."""
+    with sf.SoundFile(path) as f:
+        # libsndfile converts to the file's dtype itself, exactly for 16-bit sources
+        out = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=(f.frames, f.channels))
+        for start in range(0, f.frames, CACHE_CHUNK_FRAMES):
+            count = min(CACHE_CHUNK_FRAMES, f.frames - start)
+            f.read(count, out=out[start:start + count])
+            if progress:
+                progress((start + count) / f.frames)
+        out.flush()
+        del out
+
+def cache_path(path, samplerate, dtype='float32'):
+    """Cache file for a stem decoded at samplerate as dtype; editing the source changes the key."""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{samplerate}|{RESAMPLE_FILTER_VERSION}"
+    if dtype != 'float32':
+        key += f"|{dtype}"
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+def load_cached(path, samplerate, progress=None, dtype='float32'):
+    """Return a stem decoded at samplerate as a read-only memory map, filling the cache on a miss.
+
+    The map is sliced in place by the streaming thread, so cached stems never pass
+    through the decoder or get copied onto the Python heap. Stems keep their own
+    channel count; dtype 'int16' halves the size again, and read_stems scales it
+    back to float as it fills each block.
+    """
+    cached = cache_path(path, samplerate, dtype)
+    if os.path.exists(cached):
+        # Mark as recently used for eviction
+        os.utime(cached)
+    else:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        partial = f"{cached}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            if sf.info(path).samplerate == samplerate:
+                decode_stem(path, partial, progress, dtype)
+            else:
+                resample_stem(path, samplerate, partial, progress, dtype)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, cached)
+        trim_cache()
+    return np.load(cached, mmap_mode='r')
+
+def trim_cache(max_bytes=CACHE_MAX_BYTES):
+    """Delete the least recently used cache files until the cache fits in max_bytes."""
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npy'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, cached in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(cached)
+            total -= size
+        except OSError:
+            pass  # Removed by another job, or still mapped on Windows
+
+def peak_levels(base):
+    """Build the waveform pyramid from its finest level, halving the bin count down to one bin."""
+    levels = [base]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.concatenate([level, level[-1:]])
+        pairs = level.reshape(-1, 2, 2)
+        levels.append(np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1))
+    return levels
+
+def build_peaks(chunks, frames):
+    """Reduce (count, channels) chunks covering frames into a min/max pyramid over all channels.
+
+    Every chunk but the last must be a multiple of PEAK_BIN_FRAMES long.
+    """
+    base = np.zeros((-(-frames // PEAK_BIN_FRAMES), 2), dtype='float32')
+    start = 0
+    for chunk in chunks:
+        count = len(chunk)
+        bins = -(-count // PEAK_BIN_FRAMES)
+        if count % PEAK_BIN_FRAMES:
+            # Pad the last bin with its final frame so it doesn't pick up a false zero
+            chunk = np.concatenate([chunk, np.repeat(chunk[-1:], bins * PEAK_BIN_FRAMES - count, axis=0)])
+        grouped = np.ascontiguousarray(chunk).reshape(bins, -1)
+        base[start:start + bins, 0] = grouped.min(axis=1)
+        base[start:start + bins, 1] = grouped.max(axis=1)
+        start += bins
+    return peak_levels(base)
+
+def load_peaks(peaks_file, frames, chunks):
+    """Return the pyramid cached in peaks_file, building it from chunks() on a miss.
+
+    All levels are stored back to back in one small .npy next to the decoded audio.
+    """
+    if os.path.exists(peaks_file):
+        os.utime(peaks_file)
+        flat = np.load(peaks_file)
+        levels = []
+        bins = -(-frames // PEAK_BIN_FRAMES)
+        while True:
+            levels.append(flat[:bins])
+            flat = flat[bins:]
+            if bins <= 1:
+                return levels
+            bins = -(-bins // 2)
+    levels = build_peaks(chunks(), frames)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    partial = f"{peaks_file}.{os.getpid()}.{threading.get_ident()}.partial"
+    with open(partial, 'wb') as f:
+        np.save(f, np.concatenate(levels))
+    os.replace(partial, peaks_file)
+    return levels
+
+def stem_peaks(path, samplerate, data):
+    """Waveform pyramid of a stem decoded at samplerate, with data its cached audio."""
+    def chunks():
+        for start in range(0, len(data), CACHE_CHUNK_FRAMES):
+            yield float_samples(data[start:start + CACHE_CHUNK_FRAMES])
+    return load_peaks(cache_path(path, samplerate, data.dtype.name)[:-len(".npy")] + ".peaks.npy", len(data), chunks)
+
+def prepare_mix_peaks(tracks, samplerate, stream, dtype='float32'):
+    """Worker job: waveform pyramid of a session's stems summed at full volume.
+
+    Runs once every stem is in the cache; returns None if the session was replaced
+    or a stem can't be read.
+    """
+    tracks = [track for track in tracks if not track.get('failed')]
+    if not tracks or stream.closing:
+        return None
+    try:
+        readers = [ArrayStemReader(load_cached(track['path'], samplerate, dtype=dtype)) for track in tracks]
+        key = '|'.join(cache_path(track['path'], samplerate, dtype) for track in tracks)
+    except Exception as e:
+        print(f"Could not build the mix waveform: {e}")
+        return None
+    frames = max(reader.frames for reader in readers)
+    block = np.zeros((len(readers), CACHE_CHUNK_FRAMES, 2), dtype='float32')
+
+    def chunks():
+        for start in range(0, frames, CACHE_CHUNK_FRAMES):
+            if stream.closing:
+                raise LoadCancelled
+            count = min(CACHE_CHUNK_FRAMES, frames - start)
+            read_stems(readers, block[:, :count])
+            yield block[:, :count].sum(axis=0)
+
+    peaks_file = os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".mix.peaks.npy")
+    try:
+        return load_peaks(peaks_file, frames, chunks)
+    except LoadCancelled:
+        return None
+
+def peak_columns(levels, width):
+    """Min and max per pixel column, from the coarsest level that still has a bin per column.
+
+    Costs O(width) whatever the length of the audio.
+    """
+    level = 0
+    while level + 1 < len(levels) and len(levels[level + 1]) >= width:
+        level += 1
+    peaks = levels[level]
+    edges = np.arange(width) * len(peaks) // width
+    return np.minimum.reduceat(peaks[:, 0], edges), np.maximum.reduceat(peaks[:, 1], edges)
+
+def spectrum_bands(samplerate, rows, fft_frames=SPECTRUM_FFT_FRAMES):
+    """First rfft bin of each of rows log-spaced bands from SPECTRUM_MIN_HZ to Nyquist.
+
+    Low bands narrower than one bin repeat the bin below them.
+    """
+    bins = fft_frames // 2 + 1
+    edges = np.geomspace(SPECTRUM_MIN_HZ, samplerate / 2, rows + 1)[:-1] * fft_frames / samplerate
+    return np.minimum(edges.astype(np.intp), bins - 1)
+
+def spectrum_columns(sources, gains, first_column, count, bands, fft_frames=SPECTRUM_FFT_FRAMES,
+                     hop=SPECTRUM_HOP_FRAMES):
+    """Levels in dB, shaped (count, len(bands)), of columns first_column onwards of sources mixed by gains.
+
+    sources are (frames, channels) stem arrays. Each stem contributes one contiguous
+    read, summed to mono; the overlapping windows are strided views of that and go
+    through a single batched rfft.
+    """
+    start = first_column * hop - fft_frames // 2  # Columns are centred on their song frame
+    span = (count - 1) * hop + fft_frames
+    mono = np.zeros(span, dtype='float32')
+    for data, gain in zip(sources, gains):
+        if gain == 0:
+            continue
+        lo, hi = max(start, 0), min(start + span, len(data))
+        if lo < hi:
+            mono[lo - start:hi - start] += float_samples(data[lo:hi]).mean(axis=1) * gain
+    windows = np.lib.stride_tricks.sliding_window_view(mono, fft_frames)[::hop]
+    spectra = np.abs(np.fft.rfft(windows * np.hanning(fft_frames).astype('float32'), axis=1))
+    # Loudest bin of each band, scaled so a full-scale sine reads 0 dB
+    levels = np.maximum.reduceat(spectra, bands, axis=1) * (4 / fft_frames)
+    return (20 * np.log10(np.maximum(levels, 1e-9))).astype('float32')
+
+class SpectrogramWorker:
+    """Computes spectrogram columns up to the playhead on a background thread.
+
+    The UI calls follow() every frame with the playhead and the stem arrays to
+    analyse. The worker computes every column between the last one it produced and
+    the playhead in batches, and appends (first_column, levels) to ready, which
+    the UI drains. It reads the decoded stems directly and never touches the
+    streaming ring or audio_callback.
+    """
+
+    def __init__(self, samplerate, rows, history):
+        self.samplerate = samplerate
+        self.bands = spectrum_bands(samplerate, rows)
+        self.history = history  # Columns the UI shows; a bigger jump skips ahead instead of catching up
+        self.ready = collections.deque()
+        self.target = None  # (column, sources, gains) requested by follow()
+        self.next_column = None  # Next column to compute
+        self.wake = threading.Event()
+        self.closing = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def follow(self, frame, sources, gains):
+        """Ask for every column up to song frame, mixing sources by gains (copied)."""
+        self.target = (frame // SPECTRUM_HOP_FRAMES, list(sources), np.array(gains, dtype='float32'))
+        self.wake.set()
+
+    def _run(self):
+        while not self.closing:
+            self.wake.wait(0.1)
+            self.wake.clear()
+            while self.target is not None and not self.closing:
+                column, sources, gains = self.target
+                if self.next_column is None or not -1 <= column - self.next_column < self.history:
+                    # First request, seek or loop wrap: carry on from the playhead
+                    self.next_column = column
+                count = min(column + 1 - self.next_column, SPECTRUM_BATCH_COLUMNS)
+                if count <= 0 or not sources:
+                    break
+                try:
+                    levels = spectrum_columns(sources, gains, self.next_column, count, self.bands)
+                except Exception as e:
+                    print(f"Could not compute the spectrogram: {e}")
+                    self.target = None
+                    break
+                self.ready.append((self.next_column, levels))
+                self.next_column += count
+
+    def close(self):
+        self.closing = True
+        self.wake.set()
+
+def warm_cache(folder, match_device=True, dtype='float32'):
+    """Queue every stem under folder for decoding into the cache on decode_pool.
+
+    Each directory is treated as one session when picking the rate to decode at.
+    """
+    jobs = []
+    for dirpath, _, filenames in os.walk(folder):
+        paths = [os.path.join(dirpath, name) for name in sorted(filenames) if name.lower().endswith(AUDIO_EXTENSIONS)]
+        infos = [info for info in map(read_header, paths) if info is not None]
+        if not infos:
+            continue
+        samplerate = choose_session_samplerate([info.samplerate for info in infos], match_device)
+        jobs.extend(decode_pool.submit(warm_stem, info.name, samplerate, dtype) for info in infos)
+    return jobs
+
+def warm_stem(path, samplerate, dtype='float32'):
+    """Pool job: make sure one stem is in the cache."""
+    try:
+        stem_peaks(path, samplerate, load_cached(path, samplerate, dtype=dtype))
+    except Exception as e:
+        print(f"Could not cache sound file {path}: {e}")
+
+def read_header(path):
+    """Pool job: read a stem's header, or None if the file can't be opened."""
+    try:
+        return sf.info(path)
+    except Exception as e:
+        print(f"Could not load sound file {path}: {e}")
+        return None
+
+def prepare_track(index, track, samplerate, stream, dtype='float32'):
+    """Pool job: get one stem ready to stream at samplerate and attach it as soon as it is.
+
+    dtype is the sample format of its cache file, 'float32' or 'int16'.
+    """
+    def report(fraction):
+        if stream.closing:
+            raise LoadCancelled
+        track['progress'] = fraction
+
+    if stream.closing:
+        return
+    try:
+        if track['samplerate'] == samplerate and not os.path.exists(cache_path(track['path'], samplerate, dtype)):
+            # Stream straight from the file while the cache fills in behind it
+            stream.attach(index, FileStemReader(track['path']))
+            track['ready'] = True
+        data = load_cached(track['path'], samplerate, report, dtype)
+        reader = ArrayStemReader(data)
+    except LoadCancelled:
+        return
+    except Exception as e:
+        print(f"Could not load sound file {track['path']}: {e}")
+        # A stem already streaming from its file keeps playing without the cache
+        track['failed'] = not track['ready']
+        return
+    if stream.closing:
+        reader.close()
+        return
+    stream.attach(index, reader)
+    track['data'] = data  # Decoded audio for the spectrogram, which never reads the ring
+    track['progress'] = 1.0
+    track['ready'] = True
+    try:
+        track['peaks'] = stem_peaks(track['path'], samplerate, data)
+    except Exception as e:
+        print(f"Could not build the waveform of {track['path']}: {e}")
+
+def memory_budget(tracks, stream):
+    """Bytes held for each track as {'audio', 'buffers', 'peaks'}.
+
+    audio is the decoded cache map, which the OS pages in as it plays (0 while the
+    stem still streams from its file), buffers its share of the streamer and peaks
+    its waveform pyramid.
+    """
+    buffers = stream.buffer_bytes() if stream is not None else 0
+    return [{'audio': track['data'].nbytes if track.get('data') is not None else 0,
+             'buffers': buffers,
+             'peaks': sum(level.nbytes for level in track['peaks']) if track.get('peaks') else 0}
+            for track in tracks]
+
+def choose_session_samplerate(samplerates, match_device=True):
+    """Pick the rate every stem is converted to for this session."""
+    if match_device:
+        try:
+            # Running at the device's native rate avoids a second resample in the audio driver
+            import sounddevice as sd
+            return int(sd.query_devices(kind='output')['default_samplerate'])
+        except Exception as e:
+            print(f"Could not query the output device rate: {e}")
+    # Otherwise resample as few stems as possible
+    return max(set(samplerates), key=samplerates.count)
+
+class CallbackTelemetry:
+    """Cheap timing and xrun statistics for audio_callback, kept in preallocated arrays.
+
+    Only the audio thread writes; the UI reads without locking, so a reading can be
+    a block out of date, which is fine for display. Load is the callback's processing
+    time as a fraction of the block period.
+    """
+
+    def __init__(self, bins=TELEMETRY_BINS, recent_blocks=TELEMETRY_RECENT_BLOCKS):
+        self.bins = bins
+        self.histogram = np.zeros(bins + 1, dtype=np.int64)  # The last bucket counts missed deadlines
+        self.recent = np.zeros(recent_blocks, dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self.histogram[:] = 0
+        self.recent[:] = 0
+        self.blocks = 0
+        self.underflows = 0
+        self.overflows = 0
+        self.max_load = 0.0
+
+    def record_status(self, status):
+        """Count the xruns sounddevice reports at the start of a callback."""
+        if status.output_underflow:
+            self.underflows += 1
+        if status.output_overflow:
+            self.overflows += 1
+
+    def record_block(self, elapsed, frames, samplerate):
+        """Record one callback's processing time."""
+        load = elapsed * samplerate / frames
+        self.histogram[min(int(load * self.bins), self.bins)] += 1
+        self.recent[self.blocks % len(self.recent)] = load
+        self.blocks += 1
+        if load > self.max_load:
+            self.max_load = load
+
+    def summary(self):
+        """Statistics as plain Python values, for the overlay and the log."""
+        return {
+            'blocks': self.blocks,
+            'underflows': self.underflows,
+            'overflows': self.overflows,
+            'missed_deadlines': int(self.histogram[-1]),
+            'max_load': round(self.max_load, 4),
+            'histogram': self.histogram.tolist(),
+            'histogram_bin_width': 1 / self.bins,
+        }
+
+    def dump(self, path=TELEMETRY_LOG):
+        """Append the statistics to a log file as one JSON line."""
+        if not self.blocks:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), **self.summary())) + '\n')
+
+class StemMeters:
+    """Per-stem peak and RMS of the last mixed block, after each stem's gain.
+
+    audio_callback calls measure() every block and the UI reads peak and rms
+    without locking. Results are computed in scratch arrays and copied out at the
+    end, so a reader sees each stem's value from one block or the next, never a
+    half-finished one.
+    """
+
+    def __init__(self, n_tracks):
+        self.peak = np.zeros(n_tracks, dtype='float32')
+        self.rms = np.zeros(n_tracks, dtype='float32')
+        self.high = np.zeros(n_tracks, dtype='float32')
+        self.low = np.zeros(n_tracks, dtype='float32')
+        self.power = np.zeros((n_tracks, 1, 1), dtype='float32')
+
+    def measure(self, block, gains):
+        """Measure a (n_tracks, frames, 2) block without allocating."""
+        n, frames = block.shape[:2]
+        samples = block.reshape(n, 1, frames * 2)
+        np.maximum.reduce(samples, axis=2, out=self.high.reshape(n, 1))
+        np.minimum.reduce(samples, axis=2, out=self.low.reshape(n, 1))
+        np.negative(self.low, out=self.low)
+        np.maximum(self.high, self.low, out=self.high)
+        # Sum of squares of every stem as one batched dot product
+        np.matmul(samples, samples.reshape(n, frames * 2, 1), out=self.power)
+        self.low[:] = self.power.reshape(n)
+        self.low *= 1 / (frames * 2)
+        np.sqrt(self.low, out=self.low)
+        self.high *= gains
+        self.low *= gains
+        self.peak[:] = self.high
+        self.rms[:] = self.low
+
+    def clear(self):
+        """Show silence, for blocks where nothing is mixed."""
+        self.peak[:] = 0
+        self.rms[:] = 0
+
+def mix_block(block, gains, out):
+    """Mix a (n_tracks, frames, 2) block of stems into out (frames, 2) without allocating.
+
+    The whole mix is one gain-vector contraction written directly into out, so the
+    cost doesn't grow with a Python loop over tracks.
+    """
+    n_tracks, frames, _ = block.shape
+    # matmul works on the strided ring view as-is; np.dot would copy it first
+    np.matmul(gains, block.reshape(n_tracks, frames * 2), out=out.reshape(frames * 2))
+
+class MixGains:
+    """Per-stem gains the UI publishes as complete sets and audio_callback ramps between.
+
+    publish() writes a set into the back half of a double buffer and then flips
+    front, one store, so the callback never sees a set that is half written: a
+    solo switching every gain at once lands in one block. mix() ramps each stem
+    from the gains it reached last block to the published ones, linearly across
+    the block, so dragging a volume or muting never steps. A block whose gains
+    aren't changing costs one mix_block; a changing one adds a second contraction
+    with the gain differences, scaled by the ramp, not a loop over stems.
+
+    buffers (2, n_tracks) and front (1,) can be passed in to share them with
+    another process, as the mixer process does through its control block.
+    """
+
+    def __init__(self, n_tracks, max_frames=MIX_BLOCK_FRAMES, buffers=None, front=None):
+        self.buffers = np.ones((2, n_tracks), dtype='float32') if buffers is None else buffers
+        self.front = np.zeros(1, dtype=np.int64) if front is None else front
+        self.current = np.ones(n_tracks, dtype='float32')  # Gains reached at the end of the last block
+        self.target = np.ones(n_tracks, dtype='float32')
+        self.delta = np.zeros(n_tracks, dtype='float32')
+        self.max_frames = max_frames
+        # Per block length: fraction of the way to the new gains at each frame, reaching 1 on the last
+        self.ramps = {}
+        self.ramped = np.zeros((max_frames, 2), dtype='float32')
+
+    def published(self):
+        """The gain set the callback is ramping to."""
+        return self.buffers[self.front[0]]
+
+    def publish(self, gains):
+        """UI: hand over a complete set of gains, if it differs from the last one."""
+        front = int(self.front[0])
+        if np.array_equal(self.buffers[front], gains):
+            return
+        self.buffers[1 - front] = gains
+        self.front[0] = 1 - front
+
+    def mix(self, block, out):
+        """Mix a (n_tracks, frames, 2) block into out, ramping to the published gains, without allocating."""
+        np.copyto(self.target, self.buffers[self.front[0]])
+        for start in range(0, block.shape[1], self.max_frames):
+            self._mix(block[:, start:start + self.max_frames], out[start:start + self.max_frames])
+
+    def _mix(self, block, out):
+        frames = block.shape[1]
+        mix_block(block, self.current, out)
+        np.subtract(self.target, self.current, out=self.delta)
+        if not np.count_nonzero(self.delta):
+            return
+        ramp = self.ramps.get(frames)
+        if ramp is None:
+            ramp = self.ramps[frames] = np.arange(1, frames + 1, dtype='float32') / frames
+        ramped = self.ramped[:frames]
+        mix_block(block, self.delta, ramped)
+        # One channel at a time: broadcasting the ramp across both would allocate a buffer
+        for channel in range(2):
+            np.multiply(ramped[:, channel], ramp, out=ramped[:, channel])
+        out += ramped
+        self.current[:] = self.target
+
+    def settle(self):
+        """Jump straight to the published gains, for blocks where nothing is mixed."""
+        np.copyto(self.current, self.buffers[self.front[0]])
+
+class Limiter:
+    """Look-ahead master limiter that keeps the mix under LIMITER_CEILING without allocating.
+
+    The output is delayed by latency frames. For every output frame the gain is
+    the lowest gain any frame in the next latency frames needs, averaged over
+    latency frames so it ramps down smoothly and reaches the needed gain exactly
+    at the peak. It then recovers at a fixed rate. Each step is a vectorized pass
+    over preallocated buffers, and the delay line and gain carry over between
+    blocks, so the gain has no steps at block boundaries.
+
+    reduction_db is the largest gain reduction of the last block, for the UI.
+    """
+
+    def __init__(self, samplerate, max_frames=MIX_BLOCK_FRAMES, lookahead=LIMITER_LOOKAHEAD_FRAMES):
+        self.latency = lookahead
+        self.max_frames = max_frames
+        self.release = 1 / (LIMITER_RELEASE_S * samplerate)  # Gain recovered per frame
+        span = lookahead + max_frames
+        self.tail = np.zeros((lookahead, 2), dtype='float32')  # Input not yet played
+        self.delay = np.zeros((span, 2), dtype='float32')  # tail followed by the new block
+        self.level = np.zeros(span, dtype='float32')
+        self.low = np.zeros(span, dtype='float32')
+        # The gain is worked out in float64, which keeps the running sums exact, and
+        # only converted with copyto: ufuncs that cast on the fly allocate a buffer
+        self.needed = np.zeros(span)
+        self.window = np.zeros(span)  # Scratch for the sliding minimum
+        self.envelope_tail = np.ones(lookahead - 1)  # Last look-ahead minima of the previous block
+        self.envelope = np.ones(lookahead - 1 + max_frames)
+        self.sums = np.zeros(lookahead + max_frames)
+        self.ramp = np.arange(max_frames) * self.release
+        self.gain = np.ones(max_frames)
+        self.block_gain = np.ones(max_frames, dtype='float32')
+        self.last_gain = 1.0
+        self.reduction_db = 0.0
+
+    def process(self, out):
+        """Limit a (frames, 2) block in place, replacing it with the delayed, limited audio."""
+        for start in range(0, len(out), self.max_frames):
+            self._process(out[start:start + self.max_frames])
+
+    def _process(self, out):
+        frames = len(out)
+        lookahead = self.latency
+        span = lookahead + frames
+        delay, level, low = self.delay[:span], self.level[:span], self.low[:span]
+        needed, window = self.needed[:span], self.window[:span]
+        delay[:lookahead] = self.tail
+        delay[lookahead:] = out
+        self.tail[:] = delay[frames:]
+
+        # Gain each input frame needs on its own, from its louder channel
+        np.maximum(delay[:, 0], delay[:, 1], out=level)
+        np.minimum(delay[:, 0], delay[:, 1], out=low)
+        np.negative(low, out=low)
+        np.maximum(level, low, out=level)
+        np.copyto(needed, level)
+        np.maximum(needed, LIMITER_CEILING, out=needed)
+        np.divide(LIMITER_CEILING, needed, out=needed)
+
+        # Lowest needed gain from each output frame to lookahead frames after it, by doubling windows
+        width = lookahead + 1
+        source, target, size = needed, window, 1
+        while size * 2 <= width:
+            np.minimum(source[:span - size], source[size:], out=target[:span - size])
+            source, target, size = target, source, size * 2
+        envelope = self.envelope[:lookahead - 1 + frames]
+        envelope[:lookahead - 1] = self.envelope_tail
+        np.minimum(source[:frames], source[width - size:width - size + frames], out=envelope[lookahead - 1:])
+        self.envelope_tail[:] = envelope[frames:]
+
+        # Average over lookahead frames: the gain ramps down and still reaches each peak's gain in time
+        sums = self.sums[:lookahead + frames]
+        np.cumsum(envelope, out=sums[1:])
+        gain = self.gain[:frames]
+        np.subtract(sums[lookahead:], sums[:frames], out=gain)
+        gain *= 1 / lookahead
+
+        # Recover at most release per frame: gain[i] = min(gain[i], gain[i - 1] + release)
+        ramp = self.ramp[:frames]
+        gain -= ramp
+        np.minimum.accumulate(gain, out=gain)
+        np.minimum(gain, self.last_gain + self.release, out=gain)
+        gain += ramp
+
+        block_gain = self.block_gain[:frames]
+        np.copyto(block_gain, gain, casting='same_kind')
+        for channel in range(2):
+            np.multiply(delay[:frames, channel], block_gain, out=out[:, channel])
+        self.last_gain = float(gain[-1])
+        lowest = float(gain[np.argmin(gain)])
+        self.reduction_db = -20 * math.log10(lowest) if lowest < 1 else 0.0
+
+class NullOutput:
+    """Output backend that drives an audio callback from a thread and discards the audio.
+
+    It has the same start/stop/close interface as sounddevice.OutputStream and calls
+    callback(outdata, frames, time, status) the same way, with a (blocksize, 2)
+    float32 block and no time or status. It renders as fast as the callback returns,
+    or paced to the samplerate with realtime. frames and busy (seconds spent in the
+    callback) measure throughput.
+
+    The callback may return True when nothing is playing and the block it produced is
+    silent (sounddevice ignores the return value). The block is then dropped and the
+    output waits until wake() or the next poll instead of rendering silence.
+    """
+
+    def __init__(self, samplerate, blocksize, callback, realtime=False):
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.realtime = realtime
+        self.block = np.zeros((blocksize, 2), dtype='float32')
+        self.frames = 0  # Frames rendered since the output was opened
+        self.busy = 0.0
+        self.running = False
+        self.thread = None
+        self.waking = threading.Event()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        started = time.perf_counter()
+        rendered = 0
+        while self.running:
+            self.waking.clear()
+            callback_started = time.perf_counter()
+            idle = self.callback(self.block, self.blocksize, None, None)
+            self.busy += time.perf_counter() - callback_started
+            if idle:
+                # Paused: write nothing and sleep, then pace from scratch once playing again
+                self.waking.wait(OUTPUT_IDLE_POLL_S)
+                started = time.perf_counter()
+                rendered = 0
+                continue
+            self._write(self.block)
+            self.frames += self.blocksize
+            rendered += self.blocksize
+            if self.realtime:
+                delay = started + rendered / self.samplerate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                # Let the UI and streaming threads have the interpreter between blocks
+                time.sleep(0)
+
+    def _write(self, block):
+        pass
+
+    def wake(self):
+        """Ask the callback for a block now rather than at the next idle poll, e.g. when playback starts."""
+        self.waking.set()
+
+    def stop(self):
+        self.running = False
+        self.waking.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop()
+
+    def x_realtime(self):
+        """Audio rendered per second of callback time."""
+        return self.frames / self.samplerate / self.busy if self.busy else 0.0
+
+class FileOutput(NullOutput):
+    """Output backend that writes every block the callback produces to a sound file.
+
+    The file is created when the output is opened and finished by close().
+    """
+
+    def __init__(self, samplerate, blocksize, callback, path, realtime=False, subtype='FLOAT'):
+        super().__init__(samplerate, blocksize, callback, realtime)
+        self.path = path
+        self.file = sf.SoundFile(path, 'w', samplerate=samplerate, channels=2, subtype=subtype)
+
+    def _write(self, block):
+        self.file.write(block)
+
+    def close(self):
+        self.stop()
+        self.file.close()
+
+def open_output(backend, samplerate, blocksize, callback, path=None, realtime=False):
+    """Open an output stream that calls callback for every block, as one of OUTPUT_BACKENDS.
+
+    The stream is returned stopped; every backend supports start(), stop() and close().
+    """
+    if backend == 'sounddevice':
+        import sounddevice as sd
+        return sd.OutputStream(channels=2, samplerate=samplerate, blocksize=blocksize, callback=callback)
+    if backend == 'null':
+        return NullOutput(samplerate, blocksize, callback, realtime)
+    if backend == 'file':
+        if not path:
+            raise ValueError("the file output needs a path")
+        return FileOutput(samplerate, blocksize, callback, path, realtime)
+    raise ValueError(f"unknown output backend {backend!r}")
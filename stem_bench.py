@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import soundfile as sf
+import numpy as np
+import stem_audio
+from stem_audio import (FileStemReader, STREAM_CHUNK_FRAMES, STREAM_RING_CHUNKS, decode_stem, resample_stem,
+                        read_stems, MixGains, StemMeters, Limiter)
+
+# Benchmarks for the real-time mix path and the load pipeline, using synthetic stems
+# and no audio device. Results are printed (or written with -o) as JSON so runs from
+# different versions can be compared.
+#
+#   python stem_bench.py -o bench.json --label v2.1
+#   python stem_bench.py --quick
+
+SAMPLERATE = 44100
+MIX_STEM_COUNTS = [2, 4, 8, 16, 32, 64]
+MIX_BLOCK_SIZES = [64, 128, 256, 512, 1024]
+MIX_BLOCKS = 2000  # Blocks timed per configuration
+LOAD_LENGTHS = [30, 180]  # Seconds of audio per synthetic stem
+LOAD_LAYOUTS = [(1, 44100), (2, 44100), (2, 48000)]  # (channels, samplerate)
+
+
+def synthetic_stem(frames, channels, seed=0):
+    """Noise plus a sine, at a level where a mix of many stems still clips sometimes."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(frames) / SAMPLERATE
+    tone = 0.3 * np.sin(2 * np.pi * (110 + 55 * seed) * t)
+    data = tone[:, None] + 0.05 * rng.standard_normal((frames, channels))
+    return data.astype('float32')
+
+def percentile(times, q):
+    return float(np.percentile(times, q)) if len(times) else 0.0
+
+def bench_mix(n_stems, blocksize, blocks=MIX_BLOCKS):
+    """Time MixGains.mix, StemMeters.measure and Limiter.process the way audio_callback drives them.
+
+    Blocks are strided views of a streaming ring, and the stems are loud enough that
+    the limiter has to reduce the gain. The mix is timed with steady gains, and
+    separately with new gains published every block, so every block ramps.
+    """
+    ring_frames = STREAM_CHUNK_FRAMES * STREAM_RING_CHUNKS
+    ring = np.stack([synthetic_stem(ring_frames, 2, seed) for seed in range(n_stems)])
+    gains = np.linspace(0.5, 1.0, n_stems, dtype='float32')
+    out = np.zeros((blocksize, 2), dtype='float32')
+    other_gains = gains[::-1].copy()
+    mix_gains = MixGains(n_stems, blocksize)
+    mix_gains.publish(gains)
+    meters = StemMeters(n_stems)
+    limiter = Limiter(SAMPLERATE, blocksize)
+
+    def block_at(i):
+        index = (i * blocksize) % (ring_frames - blocksize)
+        return ring[:, index:index + blocksize]
+
+    # Warm up caches and lazily initialized BLAS state
+    for i in range(50):
+        mix_gains.mix(block_at(i), out)
+        meters.measure(block_at(i), mix_gains.current)
+        limiter.process(out)
+
+    times = np.empty(blocks)
+    meter_times = np.empty(blocks)
+    limiter_times = np.empty(blocks)
+    for i in range(blocks):
+        block = block_at(i)
+        started = time.perf_counter()
+        mix_gains.mix(block, out)
+        mixed = time.perf_counter()
+        limiter.process(out)
+        limited = time.perf_counter()
+        meters.measure(block, mix_gains.current)
+        times[i] = mixed - started
+        limiter_times[i] = limited - mixed
+        meter_times[i] = time.perf_counter() - limited
+    chain_times = times + limiter_times + meter_times
+
+    ramp_times = np.empty(blocks)
+    for i in range(blocks):
+        block = block_at(i)
+        mix_gains.publish(other_gains if i % 2 else gains)
+        started = time.perf_counter()
+        mix_gains.mix(block, out)
+        ramp_times[i] = time.perf_counter() - started
+
+    # Separate pass for allocations, since tracemalloc slows everything down
+    tracemalloc.start()
+    peak_bytes = 0
+    for i in range(200):
+        block = block_at(i)
+        mix_gains.publish(other_gains if i % 2 else gains)
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        mix_gains.mix(block, out)
+        limiter.process(out)
+        meters.measure(block, mix_gains.current)
+        peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    deadline = blocksize / SAMPLERATE
+    return {
+        'stems': n_stems,
+        'blocksize': blocksize,
+        'deadline_us': deadline * 1e6,
+        'mean_us': float(times.mean()) * 1e6,
+        'p99_us': percentile(times, 99) * 1e6,
+        'max_us': float(times.max()) * 1e6,
+        'p99_deadline_fraction': percentile(times, 99) / deadline,
+        'max_deadline_fraction': float(times.max()) / deadline,
+        'ramp_p99_us': percentile(ramp_times, 99) * 1e6,
+        'meters_p99_us': percentile(meter_times, 99) * 1e6,
+        'meters_max_us': float(meter_times.max()) * 1e6,
+        'limiter_p99_us': percentile(limiter_times, 99) * 1e6,
+        'limiter_max_us': float(limiter_times.max()) * 1e6,
+        'limiter_reduction_db': limiter.reduction_db,
+        'callback_p99_deadline_fraction': percentile(chain_times, 99) / deadline,
+        'peak_alloc_bytes_per_block': peak_bytes,
+    }
+
+def bench_load(directory, seconds, channels, samplerate):
+    """Time each load stage for one synthetic stem: header, streaming decode, cache fill and resample."""
+    path = os.path.join(directory, f"stem_{seconds}s_{channels}ch_{samplerate}.wav")
+    frames = seconds * samplerate
+    sf.write(path, synthetic_stem(frames, channels), samplerate, subtype='PCM_16')
+    audio_minutes = seconds / 60
+    result = {'seconds': seconds, 'channels': channels, 'samplerate': samplerate,
+              'file_bytes': os.path.getsize(path)}
+
+    started = time.perf_counter()
+    sf.info(path)
+    result['header_ms'] = (time.perf_counter() - started) * 1e3
+
+    # Streaming: decode the whole stem through the reader the streaming thread uses
+    reader = FileStemReader(path)
+    block = np.zeros((1, STREAM_CHUNK_FRAMES, 2), dtype='float32')
+    started = time.perf_counter()
+    for _ in range(0, frames, STREAM_CHUNK_FRAMES):
+        read_stems([reader], block)
+    elapsed = time.perf_counter() - started
+    reader.close()
+    result['stream_s_per_audio_min'] = elapsed / audio_minutes
+    result['stream_x_realtime'] = seconds / elapsed
+
+    started = time.perf_counter()
+    decode_stem(path, os.path.join(directory, "decoded.npy"))
+    elapsed = time.perf_counter() - started
+    result['cache_fill_s_per_audio_min'] = elapsed / audio_minutes
+    result['cache_fill_x_realtime'] = seconds / elapsed
+
+    # Resample to the other common rate, as a mixed-rate session would
+    target = 48000 if samplerate == 44100 else 44100
+    started = time.perf_counter()
+    resample_stem(path, target, os.path.join(directory, "resampled.npy"))
+    elapsed = time.perf_counter() - started
+    result['resample_to'] = target
+    result['resample_s_per_audio_min'] = elapsed / audio_minutes
+    result['resample_x_realtime'] = seconds / elapsed
+    return result
+
+def max_stems_within_deadline(mix_results, fraction=0.5):
+    """Largest stem count per block size whose p99 mix time stays under a fraction of the deadline."""
+    limits = {}
+    for result in mix_results:
+        if result['p99_deadline_fraction'] <= fraction:
+            limits[result['blocksize']] = max(limits.get(result['blocksize'], 0), result['stems'])
+    return {str(blocksize): limits.get(blocksize, 0) for blocksize in sorted({r['blocksize'] for r in mix_results})}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stem player's mix path and load pipeline.")
+    parser.add_argument('-o', '--output', help="write JSON results to this file instead of stdout")
+    parser.add_argument('--label', default='', help="free-form label stored with the results, e.g. a version")
+    parser.add_argument('--quick', action='store_true', help="fewer configurations and shorter stems")
+    parser.add_argument('--skip-load', action='store_true', help="only benchmark mixing")
+    args = parser.parse_args(argv)
+
+    stem_counts = [4, 16] if args.quick else MIX_STEM_COUNTS
+    block_sizes = [256, 1024] if args.quick else MIX_BLOCK_SIZES
+    blocks = MIX_BLOCKS // 4 if args.quick else MIX_BLOCKS
+    lengths = [10] if args.quick else LOAD_LENGTHS
+
+    mix_results = []
+    for n_stems in stem_counts:
+        for blocksize in block_sizes:
+            result = bench_mix(n_stems, blocksize, blocks)
+            mix_results.append(result)
+            print(f"mix {n_stems:3d} stems x {blocksize:4d} frames: p99 {result['p99_us']:8.1f} us "
+                  f"({result['p99_deadline_fraction']:.1%} of deadline), ramping {result['ramp_p99_us']:8.1f} us, meters p99 {result['meters_p99_us']:6.1f} us, "
+                  f"limiter p99 {result['limiter_p99_us']:6.1f} us, "
+                  f"mix+limiter+meters {result['callback_p99_deadline_fraction']:.1%} of deadline, "
+                  f"peak alloc {result['peak_alloc_bytes_per_block']} B", file=sys.stderr)
+
+    load_results = []
+    if not args.skip_load:
+        directory = tempfile.mkdtemp(prefix="stem-bench-")
+        try:
+            for seconds in lengths:
+                for channels, samplerate in LOAD_LAYOUTS:
+                    result = bench_load(directory, seconds, channels, samplerate)
+                    load_results.append(result)
+                    print(f"load {seconds:4d} s {channels}ch {samplerate}: stream {result['stream_x_realtime']:.0f}x, "
+                          f"cache fill {result['cache_fill_x_realtime']:.0f}x, "
+                          f"resample {result['resample_x_realtime']:.0f}x realtime", file=sys.stderr)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    results = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'soundfile': sf.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'samplerate': SAMPLERATE,
+        'decode_workers': stem_audio.DECODE_WORKERS,
+        'mix': mix_results,
+        'max_stems_within_half_deadline': max_stems_within_deadline(mix_results),
+        'load': load_results,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
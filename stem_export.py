@@ -0,0 +1,181 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import soundfile as sf
+import numpy as np
+from stem_audio import (FileStemReader, ArrayStemReader, AUDIO_EXTENSIONS, MIX_BLOCK_FRAMES, load_cached,
+                        read_stems, choose_session_samplerate, mix_block, Limiter)
+import stem_tracks
+from stem_tracks import load_track_config, describe_stems
+
+# Headless mixdown: renders a set of stems to one WAV/FLAC file through the same
+# classification and mixer as the player, without pygame, tkinter or a sound card.
+#
+#   python stem_export.py "Song - Vocals.wav" "Song - Drums.wav" -o mix.wav --mute vocals
+#   python stem_export.py --batch ~/Music/Stems -o ~/Music/Mixes --format flac --mute vocals
+
+EXPORT_CHUNK_FRAMES = 262144  # Frames read from every stem per step
+
+
+def stem_matches(stem, selector):
+    """True if a --gain/--mute/--solo selector names this stem.
+
+    A selector matches when it appears in the stem's label (with the song's common
+    words removed) or is one of the keywords of the stem's track type.
+    """
+    selector = selector.lower()
+    return selector in stem['label_without_common'].lower() or selector in stem['keywords']
+
+def stem_gains(stems, gains=(), mutes=(), solos=()):
+    """Build the mixer's gain vector from volume, mute and solo settings."""
+    mix_gains = np.ones(len(stems), dtype='float32')
+    for i, stem in enumerate(stems):
+        for selector, volume in gains:
+            if stem_matches(stem, selector):
+                mix_gains[i] = volume
+        if any(stem_matches(stem, selector) for selector in mutes):
+            mix_gains[i] = 0.0
+        if solos and not any(stem_matches(stem, selector) for selector in solos):
+            mix_gains[i] = 0.0
+    return mix_gains
+
+def render_song(file_paths, out_path, gains=(), mutes=(), solos=(), samplerate=None, subtype=None):
+    """Mix a set of stems into out_path as fast as the disk and CPU allow.
+
+    Returns a dict with the song name, the audio duration and the time it took.
+    """
+    started = time.perf_counter()
+    if not stem_tracks.track_types:
+        load_track_config()
+    name, stems = describe_stems(file_paths)
+    infos = [sf.info(stem['path']) for stem in stems]
+    if samplerate is None:
+        samplerate = choose_session_samplerate([info.samplerate for info in infos], match_device=False)
+
+    # Same per-stem sources the player streams from: the file itself or the resampled cache
+    readers = []
+    for stem, info in zip(stems, infos):
+        if info.samplerate == samplerate:
+            readers.append(FileStemReader(stem['path'], EXPORT_CHUNK_FRAMES))
+        else:
+            readers.append(ArrayStemReader(load_cached(stem['path'], samplerate)))
+    total_frames = max(-(-info.frames * samplerate // info.samplerate) for info in infos)
+
+    mix_gains = stem_gains(stems, gains, mutes, solos)
+    block = np.zeros((len(stems), EXPORT_CHUNK_FRAMES, 2), dtype='float32')
+    mix = np.zeros((EXPORT_CHUNK_FRAMES, 2), dtype='float32')
+    limiter = Limiter(samplerate)
+    skip = limiter.latency  # The limiter's delay, dropped from the start and flushed at the end
+    try:
+        with sf.SoundFile(out_path, 'w', samplerate=samplerate, channels=2, subtype=subtype) as out:
+            for start in range(0, total_frames, EXPORT_CHUNK_FRAMES):
+                count = min(EXPORT_CHUNK_FRAMES, total_frames - start)
+                read_stems(readers, block[:, :count])
+                # Mix in the player's block size so the output matches what playback sounds like
+                for offset in range(0, count, MIX_BLOCK_FRAMES):
+                    end = min(offset + MIX_BLOCK_FRAMES, count)
+                    mix_block(block[:, offset:end], mix_gains, mix[offset:end])
+                limiter.process(mix[:count])
+                out.write(mix[min(skip, count):count])
+                skip -= min(skip, count)
+            tail = mix[:limiter.latency]
+            tail[:] = 0
+            limiter.process(tail)
+            out.write(tail[skip:])
+    finally:
+        for reader in readers:
+            reader.close()
+    return {'name': name, 'out_path': out_path, 'duration': total_frames / samplerate,
+            'elapsed': time.perf_counter() - started}
+
+def find_songs(root):
+    """Return (directory, stem paths) for every directory under root that holds audio files."""
+    songs = []
+    for dirpath, _, filenames in os.walk(root):
+        paths = [os.path.join(dirpath, name) for name in sorted(filenames) if name.lower().endswith(AUDIO_EXTENSIONS)]
+        if paths:
+            songs.append((dirpath, paths))
+    return songs
+
+def batch_output_name(root, dirpath):
+    """Output name for a --batch song: its folder's path under root, so "A/stems" and "B/stems" don't collide."""
+    relative = os.path.relpath(dirpath, root)
+    if relative == os.curdir:
+        return os.path.basename(os.path.abspath(root))
+    return ' - '.join(part for part in relative.split(os.sep) if part)
+
+def report(result):
+    speed = result['duration'] / result['elapsed'] if result['elapsed'] else float('inf')
+    print(f"{result['out_path']}: {result['duration']:.1f} s of audio in {result['elapsed']:.2f} s ({speed:.1f}x realtime)")
+
+def parse_gain(text):
+    """argparse type for NAME=VOLUME, with VOLUME from 0.0 to 1.0 like the player's volume drag."""
+    selector, _, volume = text.rpartition('=')
+    if not selector:
+        raise argparse.ArgumentTypeError(f"expected NAME=VOLUME, got {text!r}")
+    return selector, max(0.0, min(1.0, float(volume)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render stems to a single mixed file without the player UI.")
+    parser.add_argument('stems', nargs='*', help="stem files to mix into one song")
+    parser.add_argument('-o', '--output', required=True,
+                        help="output file, or output directory with --batch")
+    parser.add_argument('--batch', metavar='DIR',
+                        help="render every directory of stems under DIR as its own song")
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'],
+                        help="output format for --batch (default: wav)")
+    parser.add_argument('--gain', action='append', type=parse_gain, default=[], metavar='NAME=VOLUME',
+                        help="set the volume (0.0-1.0) of stems matching NAME")
+    parser.add_argument('--mute', action='append', default=[], metavar='NAME', help="mute stems matching NAME")
+    parser.add_argument('--solo', action='append', default=[], metavar='NAME', help="only play stems matching NAME")
+    parser.add_argument('--samplerate', type=int, help="output sample rate (default: most common stem rate)")
+    parser.add_argument('--subtype', help="soundfile subtype such as PCM_24 (default: the format's default)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="songs rendered in parallel with --batch (default: one per core)")
+    args = parser.parse_args(argv)
+    settings = dict(gains=args.gain, mutes=args.mute, solos=args.solo, samplerate=args.samplerate, subtype=args.subtype)
+
+    if not args.batch:
+        if not args.stems:
+            parser.error("no stems given")
+        report(render_song(args.stems, args.output, **settings))
+        return 0
+
+    songs = find_songs(args.batch)
+    if not songs:
+        parser.error(f"no audio files found under {args.batch}")
+    os.makedirs(args.output, exist_ok=True)
+    started = time.perf_counter()
+    total_duration = 0.0
+    failures = 0
+    # One song per process: decoding and mixing a song is mostly single-threaded
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = {}
+        out_paths = set()
+        for dirpath, paths in songs:
+            out_path = os.path.join(args.output, f"{batch_output_name(args.batch, dirpath)}.{args.format}")
+            if out_path in out_paths:
+                # Folder names that only differ in separators can still meet; never overwrite a render
+                print(f"Could not render {dirpath}: {out_path} is already used by another song", file=sys.stderr)
+                failures += 1
+                continue
+            out_paths.add(out_path)
+            jobs[pool.submit(render_song, paths, out_path, **settings)] = dirpath
+        for job, dirpath in jobs.items():
+            try:
+                result = job.result()
+            except Exception as e:
+                print(f"Could not render {dirpath}: {e}", file=sys.stderr)
+                failures += 1
+                continue
+            report(result)
+            total_duration += result['duration']
+    elapsed = time.perf_counter() - started
+    print(f"Rendered {len(songs) - failures} songs, {total_duration:.1f} s of audio in {elapsed:.2f} s "
+          f"({total_duration / elapsed:.1f}x realtime)")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import stem_tracks
+from stem_audio import CACHE_DIR, AUDIO_EXTENSIONS, decode_pool, read_header
+from stem_tracks import load_track_config, find_common_words, track_labels, get_track_type
+
+# Stem library: an SQLite catalog of every song under one or more root folders, built
+# from file headers only. Rescans stat every file but re-read headers and regroup
+# songs only in directories where something was added, changed or removed.
+#
+#   python stem_library.py scan ~/Music/Stems
+#   python stem_library.py search beatles help
+
+LIBRARY_DB = os.path.join(CACHE_DIR, "library.sqlite")
+SEARCH_LIMIT = 200  # Songs returned per search
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY,
+    scanned REAL
+);
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    search TEXT NOT NULL,
+    stem_count INTEGER NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_directory ON songs (directory);
+CREATE TABLE IF NOT EXISTS stems (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    song_id INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    frames INTEGER NOT NULL,
+    samplerate INTEGER NOT NULL,
+    channels INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    label TEXT NOT NULL,
+    icon TEXT NOT NULL,
+    track_order REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stems_directory ON stems (directory);
+CREATE INDEX IF NOT EXISTS stems_song ON stems (song_id);
+"""
+
+
+def connect(db_path=LIBRARY_DB):
+    """Open the library, creating it if needed. Each thread should use its own connection."""
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    db = sqlite3.connect(db_path, timeout=30)
+    # Readers (the browser) keep working while a scan writes
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+def list_audio_files(root):
+    """Return {directory: {path: (size, mtime_ns)}} for every audio file under root."""
+    directories = {}
+    for dirpath, _, filenames in os.walk(root):
+        files = {}
+        for name in filenames:
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+        if files:
+            directories[dirpath] = files
+    return directories
+
+def song_key(path, keyword_words):
+    """A stem's filename with every track-type keyword removed; stems of one song share it."""
+    base = os.path.splitext(os.path.basename(path))[0].replace('-', ' ').replace('_', ' ')
+    return ' '.join(word for word in base.lower().split() if word not in keyword_words)
+
+def keyword_words(categories):
+    """Every word used in a track-type keyword, at any depth."""
+    words = set()
+    for category_data in categories.values():
+        for keyword in category_data.get("keywords", []):
+            words.update(keyword.lower().split())
+        words.update(keyword_words(category_data.get("subcategories", {})))
+    return words
+
+def group_songs(paths, keywords):
+    """Split the stems of one directory into songs.
+
+    Stems whose names match once the track-type keywords are taken out belong
+    together. A stem left on its own (one no keyword matched, like "Song - Synth")
+    joins the song whose common words all appear in its name, preferring the song
+    with the most of them. If every stem is still on its own, the whole directory
+    is one song, as if all of it had been opened in the player.
+
+    >>> group_songs(['Song - Vocals.wav', 'Song - Drums.wav', 'Song - Bass.wav', 'Song - Synth.wav',
+    ...              'Song - FX.wav'], {'vocals', 'drums', 'bass'})
+    [['Song - Bass.wav', 'Song - Drums.wav', 'Song - FX.wav', 'Song - Synth.wav', 'Song - Vocals.wav']]
+    """
+    groups = {}
+    for path in sorted(paths):
+        groups.setdefault(song_key(path, keywords), []).append(path)
+    songs = [group for group in groups.values() if len(group) > 1]
+    common = [{word.lower() for word in find_common_words(song)} for song in songs]
+    leftovers = []
+    for group in groups.values():
+        if len(group) > 1:
+            continue
+        base = os.path.splitext(os.path.basename(group[0]))[0].replace('-', ' ').replace('_', ' ')
+        words = set(base.lower().split())
+        matches = [(len(common[i]), len(song), i) for i, song in enumerate(songs) if common[i] <= words]
+        if matches:
+            songs[max(matches)[2]].append(group[0])
+        else:
+            leftovers.append(group)
+    if not songs:
+        return [sorted(paths)]
+    return [sorted(song) for song in songs] + leftovers
+
+def scan(root, db_path=LIBRARY_DB, progress=None):
+    """Bring the library up to date with root and return counts of what changed.
+
+    Only headers of new or modified files are read (in parallel on decode_pool),
+    and only directories with changes are regrouped into songs.
+    """
+    if not stem_tracks.track_types:
+        load_track_config()
+    keywords = keyword_words(stem_tracks.track_types)
+    root = os.path.abspath(root)
+    on_disk = list_audio_files(root)
+    db = connect(db_path)
+    try:
+        known = {}
+        pattern = os.path.join(root, '').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        for path, directory, size, mtime_ns in db.execute(
+                "SELECT path, directory, size, mtime_ns FROM stems WHERE directory = ? OR directory LIKE ? ESCAPE '\\'",
+                (root, pattern)):
+            known.setdefault(directory, {})[path] = (size, mtime_ns)
+
+        changed_directories = {directory for directory in set(on_disk) | set(known)
+                               if on_disk.get(directory) != known.get(directory)}
+        stale = [path for directory in changed_directories for path, stat in on_disk.get(directory, {}).items()
+                 if known.get(directory, {}).get(path) != stat]
+        removed = [path for directory in changed_directories for path in known.get(directory, {})
+                   if path not in on_disk.get(directory, {})]
+
+        # Headers only, no decoding
+        infos = dict(zip(stale, decode_pool.map(read_header, stale)))
+        with db:
+            db.executemany("DELETE FROM stems WHERE path = ?", [(path,) for path in removed])
+            for done, directory in enumerate(sorted(changed_directories)):
+                files = on_disk.get(directory, {})
+                for path in files:
+                    info = infos.get(path)
+                    if path in infos and info is None:
+                        db.execute("DELETE FROM stems WHERE path = ?", (path,))
+                    elif info is not None:
+                        size, mtime_ns = files[path]
+                        db.execute("INSERT OR REPLACE INTO stems (path, directory, size, mtime_ns, frames, samplerate, "
+                                   "channels, duration, label, icon, track_order) VALUES (?, ?, ?, ?, ?, ?, ?, ?, '', '', 0)",
+                                   (path, directory, size, mtime_ns, info.frames, info.samplerate, info.channels,
+                                    info.frames / info.samplerate))
+                index_directory(db, directory, keywords)
+                if progress:
+                    progress((done + 1) / len(changed_directories))
+            db.execute("INSERT OR REPLACE INTO roots (path, scanned) VALUES (?, ?)", (root, time.time()))
+        return {'files': sum(len(files) for files in on_disk.values()), 'read': len(stale),
+                'removed': len(removed), 'directories': len(changed_directories)}
+    finally:
+        db.close()
+
+def index_directory(db, directory, keywords):
+    """Regroup one directory's stems into songs, labelling and classifying each stem."""
+    db.execute("DELETE FROM songs WHERE directory = ?", (directory,))
+    rows = db.execute("SELECT path, duration FROM stems WHERE directory = ?", (directory,)).fetchall()
+    durations = dict(rows)
+    for paths in group_songs(durations, keywords):
+        common_words = find_common_words(paths)
+        name = ' '.join(common_words) or os.path.basename(directory)
+        duration = max(durations[path] for path in paths)
+        song_id = db.execute("INSERT INTO songs (directory, name, search, stem_count, duration) VALUES (?, ?, ?, ?, ?)",
+                             (directory, name, f"{name} {directory}".lower(), len(paths), duration)).lastrowid
+        for path in paths:
+            _, label = track_labels(path, common_words)
+            track_type_info = get_track_type(label, stem_tracks.track_types)
+            db.execute("UPDATE stems SET song_id = ?, label = ?, icon = ?, track_order = ? WHERE path = ?",
+                       (song_id, label, track_type_info["icon"], track_type_info.get("order", float('inf')), path))
+
+def rescan_all(db_path=LIBRARY_DB, progress=None):
+    """Rescan every root that has been scanned before."""
+    db = connect(db_path)
+    try:
+        roots = [path for (path,) in db.execute("SELECT path FROM roots")]
+    finally:
+        db.close()
+    return [scan(root, db_path, progress) for root in roots if os.path.isdir(root)]
+
+def search(db, text, limit=SEARCH_LIMIT):
+    """Songs whose name or folder contains every word of text, as (id, name, directory, stem_count, duration)."""
+    terms = text.lower().split()
+    where = ' AND '.join("search LIKE ? ESCAPE '\\'" for _ in terms) or '1'
+    params = ['%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for term in terms]
+    return db.execute(f"SELECT id, name, directory, stem_count, duration FROM songs WHERE {where} "
+                      "ORDER BY name COLLATE NOCASE LIMIT ?", params + [limit]).fetchall()
+
+def song_paths(db, song_id):
+    """Stem paths of one song, in track type order."""
+    return [path for (path,) in db.execute("SELECT path FROM stems WHERE song_id = ? ORDER BY track_order, path",
+                                           (song_id,))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and search the stem player's song library.")
+    parser.add_argument('--db', default=LIBRARY_DB, help="library file (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan_parser = commands.add_parser('scan', help="add or update every song under a folder")
+    scan_parser.add_argument('roots', nargs='*', help="folders to scan (default: rescan every known folder)")
+    search_parser = commands.add_parser('search', help="list songs matching every word")
+    search_parser.add_argument('words', nargs='*')
+    args = parser.parse_args(argv)
+
+    if args.command == 'scan':
+        started = time.perf_counter()
+        results = [scan(root, args.db) for root in args.roots] if args.roots else rescan_all(args.db)
+        for result in results:
+            print(f"{result['files']} stems, {result['read']} headers read, {result['removed']} removed, "
+                  f"{result['directories']} folders regrouped")
+        print(f"Scanned in {time.perf_counter() - started:.2f} s")
+        return 0
+
+    db = connect(args.db)
+    try:
+        for song_id, name, directory, stem_count, duration in search(db, ' '.join(args.words)):
+            print(f"{name}  ({stem_count} stems, {int(duration) // 60}:{int(duration) % 60:02d})  {directory}")
+    finally:
+        db.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
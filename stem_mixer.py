@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import argparse
+import threading
+import subprocess
+from time import perf_counter
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from stem_audio import (StemStreamer, StemMeters, MixGains, Limiter, CallbackTelemetry, FileStemReader, ArrayStemReader,
+                        MIX_BLOCK_FRAMES, OUTPUT_BACKENDS, TELEMETRY_BINS, TELEMETRY_RECENT_BLOCKS, open_output)
+
+# Mixer process: runs the streamer, mixer, limiter and output stream away from the
+# player's UI thread, so drawing, dialogs and decoding can't delay audio callbacks.
+# The player starts it with --mixer-process and talks to it through a control block
+# in shared memory; stems are the memory-mapped cache files, opened again here, so
+# no audio is ever copied between the processes.
+#
+#   python stem-player.py --mixer-process ~/Music/Stems/Song
+
+# Control block integers. Each one has a single writer: the UI writes a request,
+# then bumps its serial; the mixer applies it and copies the serial to the applied
+# field. Aligned 8-byte stores are never torn, so neither side needs a lock.
+CONTROL_FIELDS = ('seek_serial', 'seek_frame', 'applied_seek_serial',  # UI, UI, mixer
+                  'loop_serial', 'loop_start', 'loop_end',  # UI; loop_start -1 means no loop
+                  'play_serial', 'play_request', 'applied_play_serial',  # UI, UI, mixer
+                  'playing', 'play_frame', 'ready', 'buffer_bytes', 'attached',  # Mixer
+                  'blocks', 'underflows', 'overflows',  # Mixer telemetry counters
+                  'gains_front')  # UI: which half of gains the mixer ramps to
+CONTROL_LEVELS = ('reduction_db', 'max_load')  # Mixer
+
+
+class ControlBlock:
+    """Numpy views over one shared memory block holding everything the UI and mixer exchange.
+
+    Fields in CONTROL_FIELDS and CONTROL_LEVELS are read with get() and written
+    with set(); gains (UI, the two halves of a MixGains double buffer), peak, rms,
+    histogram and recent (mixer) are arrays.
+    Pass name to attach to a block another process created.
+    """
+
+    def __init__(self, n_tracks, name=None, bins=TELEMETRY_BINS, recent_blocks=TELEMETRY_RECENT_BLOCKS):
+        layout = [('values', np.int64, len(CONTROL_FIELDS)), ('levels', np.float64, len(CONTROL_LEVELS)),
+                  ('histogram', np.int64, bins + 1), ('gains', np.float32, 2 * n_tracks),
+                  ('peak', np.float32, n_tracks), ('rms', np.float32, n_tracks),
+                  ('recent', np.float32, recent_blocks)]
+        size = sum(np.dtype(dtype).itemsize * count for _, dtype, count in layout)
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1))
+        if name is not None:
+            # Only the creator removes the block; otherwise this process's resource
+            # tracker would unlink it as soon as the mixer exits
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        self.name = self.memory.name
+        self.owner = name is None
+        offset = 0
+        for attribute, dtype, count in layout:
+            setattr(self, attribute, np.ndarray(count, dtype=dtype, buffer=self.memory.buf, offset=offset))
+            offset += np.dtype(dtype).itemsize * count
+        self.gains = self.gains.reshape(2, n_tracks)
+        if self.owner:
+            self.values[:] = 0
+            self.values[CONTROL_FIELDS.index('loop_start')] = -1
+            self.levels[:] = 0
+            self.histogram[:] = 0
+            self.gains[:] = 1
+            self.peak[:] = 0
+            self.rms[:] = 0
+            self.recent[:] = 0
+
+    def get(self, field):
+        if field in CONTROL_LEVELS:
+            return float(self.levels[CONTROL_LEVELS.index(field)])
+        return int(self.values[CONTROL_FIELDS.index(field)])
+
+    def set(self, field, value):
+        if field in CONTROL_LEVELS:
+            self.levels[CONTROL_LEVELS.index(field)] = value
+        else:
+            self.values[CONTROL_FIELDS.index(field)] = value
+
+    def mix_gains(self, max_frames=MIX_BLOCK_FRAMES):
+        """A MixGains whose double buffer lives in this block."""
+        index = CONTROL_FIELDS.index('gains_front')
+        return MixGains(self.gains.shape[1], max_frames, self.gains, self.values[index:index + 1])
+
+    def bump(self, field):
+        """Publish a request: increment its serial once the request's values are written."""
+        self.set(field, self.get(field) + 1)
+
+    def close(self):
+        # The views pin the buffer, and SharedMemory refuses to close while any exist
+        del self.values, self.levels, self.histogram, self.gains, self.peak, self.rms, self.recent
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+class MixerProcess:
+    """UI side of the mixer process; stands in for the session's StemStreamer.
+
+    prepare_track and the other load jobs attach readers to it as they would to a
+    StemStreamer: each reader is closed here and the mixer opens the same file or
+    cache map itself. seek(), set_loop(), play() and gains, a MixGains the UI
+    publishes to, go through the control block; transport() reads back the position
+    once the mixer has caught up.
+    """
+
+    def __init__(self, n_tracks, total_frames, samplerate, output='sounddevice', output_path=None, realtime=False):
+        self.total_frames = total_frames
+        self.samplerate = samplerate
+        self.control = ControlBlock(n_tracks)
+        self.gains = self.control.mix_gains()
+        self.play_request = False
+        self.attached = 0  # Stems sent to the mixer; it counts the ones it has taken in the attached field
+        self.telemetry = CallbackTelemetry()  # Copy of the mixer's telemetry for the overlay
+        self.closing = False
+        command = [sys.executable, os.path.abspath(__file__), self.control.name, str(n_tracks), str(total_frames),
+                   str(samplerate), '--output', output]
+        if output_path:
+            command += ['--output-file', output_path]
+        if realtime:
+            command.append('--realtime')
+        # Commands go over stdin as JSON lines; closing it stops the mixer
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, text=True)
+        self.send_lock = threading.Lock()  # Load jobs attach stems from several pool threads
+
+    def send(self, **message):
+        with self.send_lock:
+            self._send(message)
+
+    def _send(self, message):
+        try:
+            self.process.stdin.write(json.dumps(message) + '\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def attach(self, index, reader):
+        """Hand a stem to the mixer: its source file, or the cache file behind an ArrayStemReader's map."""
+        if isinstance(reader, FileStemReader):
+            message = dict(attach=index, path=reader.file.name, kind='file')
+        else:
+            message = dict(attach=index, path=reader.data.filename, kind='array')
+        reader.close()
+        with self.send_lock:
+            self.attached += 1
+            self._send(message)
+
+    def set_speed(self, speed):
+        self.send(speed=speed)
+
+    def seek(self, frame):
+        self.control.set('seek_frame', max(0, min(int(frame), self.total_frames)))
+        self.control.bump('seek_serial')
+
+    def set_loop(self, region):
+        start, end = region if region is not None else (-1, -1)
+        self.control.set('loop_start', start)
+        self.control.set('loop_end', end)
+        self.control.bump('loop_serial')
+
+    def play(self, playing):
+        self.play_request = playing
+        self.control.set('play_request', int(playing))
+        self.control.bump('play_serial')
+
+    def settled(self):
+        """True once the mixer has applied every seek and play request sent so far."""
+        control = self.control
+        return (control.get('applied_seek_serial') == control.get('seek_serial')
+                and control.get('applied_play_serial') == control.get('play_serial'))
+
+    def transport(self):
+        """(playing, play_frame) as the mixer last reported them."""
+        return bool(self.control.get('playing')), self.control.get('play_frame')
+
+    def is_ready(self):
+        """Like StemStreamer.is_ready, once the mixer has also taken every stem attached so far."""
+        control = self.control
+        return self.settled() and control.get('attached') == self.attached and bool(control.get('ready'))
+
+    def buffer_bytes(self):
+        return self.control.get('buffer_bytes')
+
+    def read_levels(self, meters, limiter):
+        """Copy the mixer's meters, gain reduction and telemetry into the UI's objects."""
+        control = self.control
+        meters.peak[:] = control.peak
+        meters.rms[:] = control.rms
+        limiter.reduction_db = control.get('reduction_db')
+        telemetry = self.telemetry
+        telemetry.histogram[:] = control.histogram
+        telemetry.recent[:] = control.recent
+        telemetry.blocks = control.get('blocks')
+        telemetry.underflows = control.get('underflows')
+        telemetry.overflows = control.get('overflows')
+        telemetry.max_load = control.get('max_load')
+
+    def close(self):
+        """Stop the mixer process and free the control block."""
+        self.closing = True
+        with self.send_lock:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.gains = None  # Its views would keep the control block open
+        self.control.close()
+
+class Mixer:
+    """The mixer process: a StemStreamer and an output stream driven by the control block."""
+
+    def __init__(self, control, total_frames, samplerate, blocksize=MIX_BLOCK_FRAMES):
+        n_tracks = control.gains.shape[1]
+        self.control = control
+        self.samplerate = samplerate
+        self.streamer = StemStreamer([None] * n_tracks, total_frames)
+        self.gains = control.mix_gains(blocksize)
+        self.limiter = Limiter(samplerate, blocksize)
+        self.meters = StemMeters(n_tracks)
+        self.telemetry = CallbackTelemetry()
+        self.playing = False
+        self.loop_serial = 0
+        control.set('buffer_bytes', self.streamer.buffer_bytes())
+
+    def callback(self, outdata, frames, time, status):
+        """Output stream callback: apply the UI's requests, then mix the next block like the player's audio_callback."""
+        started = perf_counter()
+        control, streamer = self.control, self.streamer
+        if status:
+            self.telemetry.record_status(status)
+
+        serial = control.get('loop_serial')
+        if serial != self.loop_serial:
+            self.loop_serial = serial
+            start, end = control.get('loop_start'), control.get('loop_end')
+            streamer.set_loop((start, end) if start >= 0 else None)
+        serial = control.get('seek_serial')
+        if serial != control.get('applied_seek_serial'):
+            frame = control.get('seek_frame')
+            streamer.seek(frame)
+            control.set('play_frame', frame)
+            control.set('applied_seek_serial', serial)
+        serial = control.get('play_serial')
+        if serial != control.get('applied_play_serial'):
+            self.playing = bool(control.get('play_request'))
+            control.set('playing', self.playing)
+            control.set('applied_play_serial', serial)
+
+        block = streamer.read(frames) if self.playing else None
+        if block is None:
+            outdata.fill(0)
+            self.gains.settle()
+            self.limiter.process(outdata)
+            self.meters.clear()
+        else:
+            self.gains.mix(block, outdata)
+            self.limiter.process(outdata)
+            self.meters.measure(block, self.gains.current)
+            streamer.advance(frames)
+            control.set('play_frame', streamer.play_frame)
+            if streamer.play_frame >= streamer.total_frames:
+                self.playing = False
+                control.set('playing', False)
+        control.set('ready', streamer.is_ready())
+        self.telemetry.record_block(perf_counter() - started, frames, self.samplerate)
+        self.publish()
+        # Lets the null and file outputs idle while paused; they poll for the next play request
+        return not self.playing and not outdata.any()
+
+    def publish(self):
+        """Copy the levels and telemetry the UI shows into the control block."""
+        control, telemetry = self.control, self.telemetry
+        control.peak[:] = self.meters.peak
+        control.rms[:] = self.meters.rms
+        control.histogram[:] = telemetry.histogram
+        control.recent[:] = telemetry.recent
+        control.set('reduction_db', self.limiter.reduction_db)
+        control.set('max_load', telemetry.max_load)
+        control.set('blocks', telemetry.blocks)
+        control.set('underflows', telemetry.underflows)
+        control.set('overflows', telemetry.overflows)
+
+    def handle(self, message):
+        """Apply one command from the UI: attach a stem or change the speed."""
+        if 'attach' in message:
+            try:
+                if message['kind'] == 'file':
+                    reader = FileStemReader(message['path'])
+                else:
+                    reader = ArrayStemReader(np.load(message['path'], mmap_mode='r'))
+                self.streamer.attach(message['attach'], reader)
+            finally:
+                # Counted even if the stem can't be opened, so is_ready() doesn't wait for it forever
+                self.control.bump('attached')
+        if 'speed' in message:
+            self.streamer.set_speed(message['speed'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mixer process started by the stem player with --mixer-process.")
+    parser.add_argument('control', help="name of the shared memory control block")
+    parser.add_argument('tracks', type=int)
+    parser.add_argument('frames', type=int, help="session length in frames")
+    parser.add_argument('samplerate', type=int)
+    parser.add_argument('--output', choices=OUTPUT_BACKENDS, default='sounddevice')
+    parser.add_argument('--output-file')
+    parser.add_argument('--realtime', action='store_true')
+    args = parser.parse_args(argv)
+
+    control = ControlBlock(args.tracks, args.control)
+    mixer = Mixer(control, args.frames, args.samplerate)
+    stream = None
+    try:
+        stream = open_output(args.output, args.samplerate, MIX_BLOCK_FRAMES, mixer.callback,
+                             args.output_file, args.realtime)
+        stream.start()
+    except Exception as e:
+        stream = None
+        print(f"Could not open the audio output: {e}")
+    try:
+        # Runs until the player closes stdin
+        for line in sys.stdin:
+            try:
+                mixer.handle(json.loads(line))
+            except Exception as e:
+                print(f"Mixer process: could not apply {line.strip()}: {e}")
+    finally:
+        if stream is not None:
+            stream.stop()
+            stream.close()
+            if args.output != 'sounddevice':
+                print(f"Output: {stream.frames / stream.samplerate:.1f} s rendered, "
+                      f"{stream.x_realtime():.0f}x realtime")
+        mixer.streamer.close()
+        mixer.telemetry.dump()
+        mixer.gains = None  # Its views would keep the control block open
+        control.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
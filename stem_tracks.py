@@ -0,0 +1,204 @@
+import os
+import re
+import json
+import time
+from functools import lru_cache
+
+# Track classification shared by the player and the command-line tools.
+# load_track_config() must be called before get_track_type() is used; after that,
+# edits to the config file are picked up automatically.
+
+track_types = {}  # Hierarchical dictionary loaded from track_types.json
+default_icon_filename = "music-notes.png"
+default_color = [150, 150, 150]
+matcher = None  # TrackTypeMatcher compiled from track_types
+config_path = None  # File track_types was loaded from, watched for changes
+config_mtime_ns = None
+last_config_check = 0.0
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "track_types.json")
+CONFIG_CHECK_INTERVAL = 1.0  # Seconds between checks of the config file for changes
+
+
+def load_track_config(config_file=CONFIG_FILE):
+    """Load track type configurations from the JSON file and assign their order indices."""
+    global track_types, default_icon_filename, default_color, matcher, config_path, config_mtime_ns, last_config_check
+    # Stat before reading so an edit made while loading is picked up by the next check
+    mtime_ns = os.stat(config_file).st_mtime_ns
+    with open(config_file, "r") as f:
+        config_data = json.load(f)
+
+    track_types = config_data["track_types"]  # Hierarchical dictionary
+
+    # Assign order indices to track types
+    assign_order_indices(track_types)
+
+    default_icon_filename = config_data.get("default_icon", "music-notes.png")
+    default_color = config_data.get("default_color", [150, 150, 150])
+
+    matcher = TrackTypeMatcher(track_types)
+    classify.cache_clear()
+    config_path, config_mtime_ns = config_file, mtime_ns
+    last_config_check = time.monotonic()
+    return track_types
+
+def reload_if_changed():
+    """Reload the track type config if its file changed since it was loaded.
+
+    The file is checked at most once every CONFIG_CHECK_INTERVAL seconds. A file
+    that fails to parse (for example, half-saved) leaves the current config in place.
+    """
+    global last_config_check, config_mtime_ns
+    now = time.monotonic()
+    if config_path is None or now - last_config_check < CONFIG_CHECK_INTERVAL:
+        return False
+    last_config_check = now
+    try:
+        mtime_ns = os.stat(config_path).st_mtime_ns
+    except OSError:
+        return False  # Deleted or being replaced; keep the current config
+    if mtime_ns == config_mtime_ns:
+        return False
+    try:
+        load_track_config(config_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not reload {config_path}: {e}")
+        config_mtime_ns = mtime_ns  # Don't retry until the file changes again
+        return False
+    return True
+
+def assign_order_indices(categories, start_index=0):
+    """Assign order indices to categories based on their position."""
+    current_index = start_index
+
+    for category_name, category_data in categories.items():
+        # Assign the current index to this category
+        category_data['order'] = current_index
+        current_index += 1
+
+        # Recursively assign order indices to subcategories
+        subcategories = category_data.get("subcategories", {})
+        if subcategories:
+            current_index = assign_order_indices(subcategories, current_index)
+    return current_index
+
+class TrackTypeMatcher:
+    """Every keyword of a track_types tree compiled into one regular expression.
+
+    The rule is that the deepest category with a keyword in the filename wins,
+    and among equally deep ones the first in the file. Alternatives are ordered
+    that way and wrapped in a lookahead, so the regex reports the best keyword
+    starting at each position, overlapping ones included, and the best of those is
+    the answer.
+    """
+
+    def __init__(self, categories):
+        entries = []  # (level, keyword, category_data) in traversal order
+
+        def collect(categories, level=0):
+            for category_name, category_data in categories.items():
+                for keyword in category_data.get("keywords", []):
+                    entries.append((level, keyword.lower(), category_data))
+                collect(category_data.get("subcategories", {}), level + 1)
+
+        collect(categories)
+        ranked = sorted(range(len(entries)), key=lambda i: (-entries[i][0], i))
+        self.ranks = {}  # Keyword -> (rank, category_data) for its best occurrence
+        for rank, i in enumerate(ranked):
+            self.ranks.setdefault(entries[i][1], (rank, entries[i][2]))
+        alternatives = '|'.join(re.escape(entries[i][1]) for i in ranked)
+        self.pattern = re.compile(f"(?=({alternatives}))") if entries else None
+        # Return default with a high order index to place it at the end
+        self.default = {
+            "icon": default_icon_filename,
+            "color": default_color,
+            "order": float('inf')  # Default tracks will be placed at the end
+        }
+
+    def match(self, filename_lower):
+        best = None
+        if self.pattern is not None:
+            for found in self.pattern.finditer(filename_lower):
+                ranked = self.ranks[found.group(1)]
+                if best is None or ranked[0] < best[0]:
+                    best = ranked
+        return best[1] if best else self.default
+
+@lru_cache(maxsize=4096)
+def classify(filename_lower):
+    """Memoized matcher.match for the loaded config; cleared whenever it is reloaded."""
+    return matcher.match(filename_lower)
+
+def get_track_type(filename, categories):
+    """Determine the track type based on keywords in the filename."""
+    loaded = track_types
+    if reload_if_changed() and categories is loaded:
+        # The caller passed the config that was just replaced
+        categories = track_types
+    if categories is not track_types or matcher is None:
+        # Some other tree than the loaded config: compile it just for this call
+        return TrackTypeMatcher(categories).match(filename.lower())
+    return classify(filename.lower())
+
+def find_common_words(filenames):
+    """Find the common words in the list of filenames, preserving order."""
+    if not filenames:
+        return []
+    # Extract base names without extensions
+    bases = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    # Replace hyphens and underscores with spaces
+    bases = [b.replace('-', ' ').replace('_', ' ') for b in bases]
+    # Split into words
+    split_names = [b.split() for b in bases]
+    # Lowercase word sets of the other filenames for comparison
+    other_word_sets = [{word.lower() for word in words} for words in split_names[1:]]
+    # Use the first filename's words as the basis for order
+    first_words = [word.lower() for word in split_names[0]]
+    # Initialize common words list
+    common_words = []
+    for idx, word in enumerate(first_words):
+        if all(word in other_words for other_words in other_word_sets):
+            # Use the original word from the first filename to preserve case
+            common_words.append(split_names[0][idx])
+    return common_words
+
+def track_labels(file_path, common_words):
+    """Return a stem's full label and its label with the words common to the session removed."""
+    full_label = os.path.splitext(os.path.basename(file_path))[0]
+    # Replace hyphens and underscores with spaces
+    full_label_processed = full_label.replace('-', ' ').replace('_', ' ')
+    # Split into words
+    words = full_label_processed.split()
+    # Remove common words (case-insensitive)
+    common_lower = {w.lower() for w in common_words}
+    label_words = [word for word in words if word.lower() not in common_lower]
+    label_without_common = ' '.join(label_words)
+    if not label_without_common.strip():
+        label_without_common = 'Track'
+    return full_label, label_without_common
+
+def describe_stems(file_paths):
+    """Label and classify a set of stems the way the player shows them.
+
+    Returns the common artist/track name and one dict per stem, sorted by the
+    track type order from track_types.json.
+    """
+    reload_if_changed()
+    common_words = find_common_words(file_paths)
+    stems = []
+    for file_path in file_paths:
+        full_label, label_without_common = track_labels(file_path, common_words)
+        # Get track type information from JSON config
+        track_type_info = get_track_type(label_without_common, track_types)
+        stems.append({
+            'path': file_path,
+            'full_label': full_label,
+            'label_without_common': label_without_common,
+            'icon_filename': track_type_info["icon"],
+            'color': track_type_info["color"],
+            'keywords': track_type_info.get("keywords", []),
+            'order': track_type_info.get("order", float('inf'))  # Use 'inf' if 'order' is missing
+        })
+    # Sort tracks based on the 'order' value
+    stems.sort(key=lambda t: t['order'])
+    return ' '.join(common_words), stems